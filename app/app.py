@@ -14,6 +14,7 @@ SRC_URL = "https://github.com/wgong/gpt3sql"
 # Imports
 #####################################################
 # generic import
+from copy import deepcopy
 from datetime import datetime, date, timedelta
 from os.path import exists
 from traceback import format_exc
@@ -24,12 +25,27 @@ import yaml
 from traceback import format_exc
 import sys
 from io import StringIO
+import re
+import time
 
 import streamlit as st
 from st_aggrid import GridOptionsBuilder, AgGrid, GridUpdateMode, DataReturnMode
 
 # import modules of this app 
 import openai
+from completion import create_completion, RateLimitError, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from jobs import submit_job, select_jobs, get_job, delete_finished_jobs, TABLE_JOBS, JOB_QUEUED, JOB_RUNNING
+from result_cache import SQL_RESULT_CACHE
+from db_common import TABLE_GPT3_LOG
+from ingest_data import ingest_file, IF_EXISTS_OPTIONS
+from log_schema import migrate, typed_values, ts_epoch
+from log_usage import ensure_usage, select_usage, TABLE_USAGE
+from profiling import Profiler, pstats_top, KIND_SQL, KIND_UI
+from parquet_export import export_log, save_result, EXPORT_DIR
+from schema_prune import prune_schema, schema_header, TOP_K
+from sample_db import build_sample, run_on_sample, SAMPLE_FRACTION
+from sql_engine import submit_query, timed_query, available_engines, compare_timings, ENGINES, ENGINE_SQLITE
+from sqlite_explore import ExploreConn, EXPLORE_TIMEOUT_SEC, QueryCancelled, QueryTimeout
 
 _STR_APP_NAME               = "GPT-3 Codex"
 
@@ -47,6 +63,7 @@ _STR_MENU_SQL_GEN_RUN       = "Generate/Run Code"
 _STR_MENU_SQL_GEN           = "Generate Code"
 _STR_MENU_SQL_RUN           = "Review/Run Code"
 _STR_MENU_SQLITE_SAMPLE     = "Explore SQLite Sample DB"
+_STR_MENU_JOBS              = "Background Jobs"
 _STR_MENU_SETTINGS          = "Configure Settings"
 _STR_MENU_NOTES             = "Take Notes"
 
@@ -69,10 +86,26 @@ _GRID_OPTIONS = {
     "groupSelectsFiltered": True,
     "enable_pagination": True,
     "paginationPageSize": 10,
+    # lightweight mode: only preview text is sent; grid reruns on selection only,
+    # AS_INPUT skips filtering (st_aggrid 0.3.5 still returns all preview rows)
+    "preview_length": 80,
+    "lite_return_mode_value": DataReturnMode.__members__["AS_INPUT"],
+    "lite_update_mode_value": GridUpdateMode.__members__["SELECTION_CHANGED"],
 }
 
-TABLE_GPT3_LOG = "T_GPT3_LOG"
+# background jobs
+BACKGROUND_TIMEOUT_SEC = 600
+JOB_REFRESH_SEC = 2
+
+# runs SELECT on every available engine and reports timings side by side
+ENGINE_COMPARE = "compare"
+
+# "grid" renders SQL results, others save them under EXPORT_DIR
+RESULT_OUTPUTS = ["grid", "parquet", "arrow"]
+
 TABLE_NOTES = "t_resource"
+# tables the app itself maintains, kept out of samples and SQL prompts
+APP_TABLES = [TABLE_GPT3_LOG, TABLE_NOTES, TABLE_JOBS, TABLE_USAGE]
 
 EDITABLE_COLUMNS = {
     TABLE_GPT3_LOG : [],   # ["comment"],
@@ -114,6 +147,18 @@ EXAMPLE_PROMPT = {
 }
 
 
+# functions timed per rerun when profiling is on
+PROFILED_SQL_FNS = [
+    "_get_tables", "_select_log", "_select_log_models", "_select_log_row", "_insert_log", "_delete_log", "_update_log",
+    "_select_note", "_select_note_row", "_insert_note", "_update_note", "_delete_note",
+    "_execute_code_sql", "_execute_code_sql_sample",
+    # DB helpers imported from other modules
+    "select_jobs", "get_job", "submit_job", "delete_finished_jobs", "select_usage",
+    "export_log", "ingest_file", "build_sample", "run_on_sample", "prune_schema",
+]
+PROFILED_UI_FNS = ["_load_settings", "_display_grid_df"]
+
+
 #####################################################
 # Helpers (prefix with underscore)
 #####################################################
@@ -133,6 +178,15 @@ def _escape_single_quote(s):
 def _unescape_single_quote(s):
     return s.replace("\'\'", "\'")
 
+def _sql_literal(val):
+    """format a value as SQL literal: NULL, number or quoted string
+    """
+    if val is None:
+        return "NULL"
+    if isinstance(val, (int, float)):
+        return str(val)
+    return f"'{_escape_single_quote(str(val))}'"
+
 def _move_item_to_first(lst, item):
     """Move item found in a list to position 0
     """
@@ -159,7 +213,7 @@ class DBConn(object):
 def _get_tables():
     """get a list of tables from SQLite database
     """
-    with DBConn(CFG["DB_FILE"]) as _conn:
+    with ExploreConn(CFG["DB_FILE"]) as _conn:
         sql_stmt = f'''
         SELECT 
             name
@@ -177,6 +231,9 @@ def _load_settings():
     with open("cfg/settings.yaml") as f:
         CFG = yaml.load(f.read(), Loader=yaml.SafeLoader)
 
+    migrate(CFG["DB_FILE"])
+    ensure_usage(CFG["DB_FILE"])
+
     if exists(CFG["API_KEY_FILE"]):
         with open(CFG["API_KEY_FILE"]) as f:
             KEY = yaml.load(f.read(), Loader=yaml.SafeLoader)
@@ -228,30 +285,74 @@ def _save_settings():
         }
         yaml.dump(KEY, f, default_flow_style=False)
 
-def _select_log():
+def _select_log(use_case=None, model=None, since=None):
+    """filters map to indexes on (use_case, ts_epoch), (model, ts_epoch), (ts_epoch)
+    """
+    where_clause, params = [], []
+    if use_case:
+        where_clause.append("use_case = ?")
+        params.append(use_case)
+    if model:
+        where_clause.append("model = ?")
+        params.append(model)
+    if since is not None:
+        where_clause.append("ts_epoch >= ?")
+        params.append(datetime.combine(since, datetime.min.time()).timestamp())
+    with DBConn(CFG["DB_FILE"]) as _conn:
+        sql_stmt = f"""
+            select ts,use_case,model,prompt,comment,output,valid_output,settings,uuid
+            from {TABLE_GPT3_LOG} 
+            {"where " + " and ".join(where_clause) if where_clause else ""}
+            order by ts_epoch desc ;
+        """
+        return pd.read_sql(sql_stmt, _conn, params=params)
+
+def _select_log_models():
+    """models present in the log, read from index on (model, ts_epoch)
+    """
+    with DBConn(CFG["DB_FILE"]) as _conn:
+        sql_stmt = f"""
+            select distinct model from {TABLE_GPT3_LOG}
+            where model is not null
+            order by model ;
+        """
+        return pd.read_sql(sql_stmt, _conn)["model"].to_list()
+
+def _select_log_row(uuid):
     with DBConn(CFG["DB_FILE"]) as _conn:
         sql_stmt = f"""
             select ts,use_case,prompt,comment,output,valid_output,settings,uuid
             from {TABLE_GPT3_LOG} 
-            order by ts desc ;
+            where uuid = ? ;
         """
-        return pd.read_sql(sql_stmt, _conn)
+        df = pd.read_sql(sql_stmt, _conn, params=(uuid,))
+    return df.to_dict("records")[0] if len(df) else None
 
-def _insert_log(use_case, settings, prompt,  output, comment='', valid_output=''):
+def _insert_log(use_case, settings, prompt,  output, comment='', valid_output='', usage=None):
+    ts = str(datetime.now())
+    typed = typed_values(ts, settings)
+    usage = usage or {}
     with DBConn(CFG["DB_FILE"]) as _conn:
         insert_sql = f"""
             insert into {TABLE_GPT3_LOG} (
-                uuid, ts, use_case, settings, prompt,  output,comment,valid_output
+                uuid, ts, use_case, settings, prompt,  output,comment,valid_output,
+                ts_epoch, model, temperature, max_tokens, prompt_tokens, completion_tokens
             )
             values (
                 '{str(uuid4())}',
-                '{str(datetime.now())}',
+                '{ts}',
                 '{use_case}',
                 '{_escape_single_quote(settings)}',
                 '{_escape_single_quote(prompt)}',
                 '{_escape_single_quote(output)}',
                 '{_escape_single_quote(comment)}',
-                '{_escape_single_quote(valid_output)}'
+                '{_escape_single_quote(valid_output)}',
+                {_sql_literal(typed["ts_epoch"])},
+                {_sql_literal(typed["model"])},
+                {_sql_literal(typed["temperature"])},
+                {_sql_literal(typed["max_tokens"])},
+                {_sql_literal(usage.get("prompt_tokens"))},
+                {_sql_literal(usage.get("completion_tokens"))}
             );
         """
         print(insert_sql)
@@ -285,6 +386,8 @@ def _update_log():
         for col,val in data.items():
             if col == "uuid": continue
             set_clause.append(f"{col} = '{_escape_single_quote(val)}'")
+        if "ts" in data:
+            set_clause.append(f"ts_epoch = {_sql_literal(ts_epoch(data['ts']))}")
         update_sql = f"""
             update {TABLE_GPT3_LOG}
             set {', '.join(set_clause)}
@@ -303,6 +406,36 @@ def _display_refresh_log():
     with c2:
         st.info(STR_FETCH_LOG)
 
+def _display_export_log():
+    c1, _, c2 = st.columns([3,2,3])
+    with c1:
+        btn_export = st.button('Export to Parquet')
+    with c2:
+        st.info(f"Append new log rows to {EXPORT_DIR}")
+    if btn_export:
+        try:
+            files = export_log(CFG["DB_FILE"])
+            st.success(f"Exported {len(files)} file(s)" if files else "Nothing to export")
+        except Exception:
+            st.error(format_exc())
+
+def _display_usage_overview(use_case=None, model=None, since=None):
+    """reads aggregates maintained by triggers, never scans the log
+    """
+    if not st.checkbox("Show usage overview", value=False, key="log_show_usage"):
+        return
+    df = select_usage(CFG["DB_FILE"], use_case=use_case, model=model, since_day=since)
+    if df.empty:
+        st.info("No usage recorded")
+        return
+    totals = df[["n_prompts", "n_validated", "prompt_tokens", "completion_tokens"]].sum()
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Prompts", f"{totals['n_prompts']:,}")
+    c2.metric("Validated", f"{totals['n_validated']:,}")
+    c3.metric("Prompt tokens", f"{totals['prompt_tokens']:,}")
+    c4.metric("Completion tokens", f"{totals['completion_tokens']:,}")
+    st.dataframe(df)
+
 def _display_delete_log(selected_row):
     data = {"uuid" : selected_row.get("uuid", "")}
     st.session_state.update({"LOG_DELETE_DATA": data})
@@ -363,30 +496,64 @@ def _display_update_log(selected_row):
 
 
 
+def _truncate_text_columns(df, preview_length=_GRID_OPTIONS["preview_length"]):
+    """shorten long text cells to preview_length chars
+    """
+    df_preview = df.copy()
+    for col in df_preview.columns:
+        if not (pd.api.types.is_object_dtype(df_preview[col]) or pd.api.types.is_string_dtype(df_preview[col])):
+            continue
+        s = df_preview[col].astype(str)
+        long_ = df_preview[col].notna() & (s.str.len() > preview_length)
+        if long_.any():
+            df_preview.loc[long_, col] = s[long_].str.slice(0, preview_length) + "..."
+    return df_preview
+
+def _build_grid_options(df, selection_mode, page_size):
+    """build AgGrid options once per column set and cache them in session
+    """
+    cache = st.session_state.setdefault("GRID_OPTIONS_CACHE", {})
+    cache_key = (tuple(df.columns), tuple(str(t) for t in df.dtypes), selection_mode, page_size)
+    if cache_key not in cache:
+        gb = GridOptionsBuilder.from_dataframe(df.head(0))
+        gb.configure_selection(selection_mode,
+                use_checkbox=True,
+                groupSelectsChildren=_GRID_OPTIONS["groupSelectsChildren"], 
+                groupSelectsFiltered=_GRID_OPTIONS["groupSelectsFiltered"]
+            )
+        gb.configure_pagination(paginationAutoPageSize=False, 
+            paginationPageSize=page_size)
+        gb.configure_columns(EDITABLE_COLUMNS[f"{TABLE_GPT3_LOG}"], editable=True)
+        gb.configure_grid_options(domLayout='normal')
+        cache[cache_key] = gb.build()
+    return deepcopy(cache[cache_key])
+
 def _display_grid_df(df, 
     selection_mode="multiple", 
     page_size=_GRID_OPTIONS["paginationPageSize"],
-    grid_height=_GRID_OPTIONS["grid_height"]):
+    grid_height=_GRID_OPTIONS["grid_height"],
+    lightweight=False):
     """show df in a grid and return selected row
+
+    lightweight=True sends only preview-length text and reruns on selection changes only;
+    st_aggrid 0.3.5 still rebuilds response data from every (preview) row,
+    so caller should fetch full row for the selection
     """
     # st.dataframe(df) 
-    gb = GridOptionsBuilder.from_dataframe(df)
-    gb.configure_selection(selection_mode,
-            use_checkbox=True,
-            groupSelectsChildren=_GRID_OPTIONS["groupSelectsChildren"], 
-            groupSelectsFiltered=_GRID_OPTIONS["groupSelectsFiltered"]
-        )
-    gb.configure_pagination(paginationAutoPageSize=False, 
-        paginationPageSize=page_size)
-    gb.configure_columns(EDITABLE_COLUMNS[f"{TABLE_GPT3_LOG}"], editable=True)
-    gb.configure_grid_options(domLayout='normal')
+    if lightweight:
+        df = _truncate_text_columns(df)
+        return_mode = _GRID_OPTIONS["lite_return_mode_value"]
+        update_mode = _GRID_OPTIONS["lite_update_mode_value"]
+    else:
+        return_mode = _GRID_OPTIONS["return_mode_value"]
+        update_mode = _GRID_OPTIONS["update_mode_value"]
     grid_response = AgGrid(
         df, 
-        gridOptions=gb.build(),
+        gridOptions=_build_grid_options(df, selection_mode, page_size),
         height=grid_height, 
         # width='100%',
-        data_return_mode=_GRID_OPTIONS["return_mode_value"],
-        update_mode=_GRID_OPTIONS["update_mode_value"],
+        data_return_mode=return_mode,
+        update_mode=update_mode,
         fit_columns_on_grid_load=_GRID_OPTIONS["fit_columns_on_grid_load"],
         allow_unsafe_jscode=True, #Set it to True to allow jsfunction to be injected
     )
@@ -397,15 +564,28 @@ def _display_grid_df(df,
 
 def _display_grid_gpt3_log(page_size=10, grid_height=370):
     with st.expander("Review logs of promp/response: ", expanded=False):
-        df_log = _select_log()
+        c1, c2, c3 = st.columns([3,3,3])
+        with c1:
+            use_case = st.selectbox("Filter use case", [""] + CFG["Use_case"], key="log_filter_use_case")
+        with c2:
+            model = st.selectbox("Filter model", [""] + _select_log_models(), key="log_filter_model")
+        with c3:
+            days = st.number_input("Last N days (0 = all)", min_value=0, value=0, key="log_filter_days")
+        since = date.today() - timedelta(days=days-1) if days else None
+        _display_usage_overview(use_case=use_case or None, model=model or None, since=since)
+        df_log = _select_log(use_case=use_case or None, model=model or None, since=since)
         _display_refresh_log()
 
-        grid_response = _display_grid_df(df_log, selection_mode="single", page_size=page_size, grid_height=grid_height)
+        grid_response = _display_grid_df(df_log, selection_mode="single", page_size=page_size, grid_height=grid_height, lightweight=True)
+        _display_export_log()
         if grid_response:
             selected_rows = grid_response['selected_rows']
             if selected_rows:
-                _display_delete_log(selected_rows[0])
-                _display_update_log(selected_rows[0])
+                # grid holds preview text only, fetch full row
+                selected_row = _select_log_row(selected_rows[0].get("uuid"))
+                if selected_row is not None:
+                    _display_delete_log(selected_row)
+                    _display_update_log(selected_row)
 
 
 def _select_note():
@@ -417,6 +597,16 @@ def _select_note():
         """
         return pd.read_sql(sql_stmt, _conn)
 
+def _select_note_row(uuid):
+    with DBConn(CFG["DB_FILE"]) as _conn:
+        sql_stmt = f"""
+            select ts,topic,url,comment,uuid
+            from {TABLE_NOTES} 
+            where uuid = ? ;
+        """
+        df = pd.read_sql(sql_stmt, _conn, params=(uuid,))
+    return df.to_dict("records")[0] if len(df) else None
+
 def _update_note(data):
     # print(f"_update_note: \n{data}")
     if not data or len(data) < 3: 
@@ -483,12 +673,13 @@ def _insert_note(data):
 
 def _display_grid_notes():
     df_note = _select_note()
-    grid_response = _display_grid_df(df_note, selection_mode="single", page_size=5, grid_height=220)
+    grid_response = _display_grid_df(df_note, selection_mode="single", page_size=5, grid_height=220, lightweight=True)
     selected_row = None
     if grid_response:
         selected_rows = grid_response['selected_rows']
         if selected_rows and len(selected_rows):
-            selected_row = selected_rows[0]
+            # grid holds preview text only, fetch full row
+            selected_row = _select_note_row(selected_rows[0].get("uuid"))
 
     ts_old = selected_row.get("ts") if selected_row is not None else ""
     uuid_old = selected_row.get("uuid") if selected_row is not None else ""
@@ -540,17 +731,126 @@ def _display_grid_notes():
     if btn_delete and selected_row is not None:
         _delete_note(data)
 
-def _execute_code_sql(code):
-    with DBConn(CFG["DB_FILE"]) as _conn:
-        if code.strip().lower().startswith("select"):
-            df = pd.read_sql(code, _conn)
+def _run_explore_query(db_file, code, engine=ENGINE_SQLITE, timeout_sec=EXPLORE_TIMEOUT_SEC):
+    """run SELECT on a read-only connection in a worker thread, return (df, timings);
+    a rerun (e.g. Cancel button) interrupts the poll loop and cancels the query
+    """
+    future, cancel_event = submit_query(engine, db_file, code, timeout_sec=timeout_sec)
+    st.button("Cancel query", key=f"cancel_explore_query_{engine}")
+    placeholder = st.empty()
+    ts_start = time.monotonic()
+    try:
+        while not future.done():
+            placeholder.caption(f"Running query on {engine} ... {time.monotonic()-ts_start:.1f} sec (timeout = {timeout_sec} sec)")
+            time.sleep(0.1)
+    finally:
+        cancel_event.set()
+    placeholder.empty()
+    return future.result()
+
+def _engine_options():
+    """available engines, plus "compare" when more than one
+    """
+    engines = available_engines()
+    return engines + [ENGINE_COMPARE] if len(engines) > 1 else engines
+
+def _execute_code_sql(code, explore=False, save_as=None, engine=ENGINE_SQLITE):
+    """run SQL against DB_FILE,
+    SELECT goes through a read-only connection with a deadline on the chosen engine
+    ("compare" runs all engines and shows timings side by side),
+    write statements are refused when explore=True,
+    save_as="parquet"/"arrow" writes the result to a file instead of rendering it
+    """
+    db_file = CFG["DB_FILE"]
+    if code.strip().lower().startswith("select"):
+        if engine == ENGINE_COMPARE:
+            results = {}
+            for name in available_engines():
+                try:
+                    results[name] = _run_explore_query(db_file, code, engine=name) + (None,)
+                except Exception as e:
+                    results[name] = (None, {}, f"{type(e).__name__}: {e}")
+            st.dataframe(compare_timings(results))
+            df, _, error = results[ENGINE_SQLITE]
+            if df is None:
+                st.error(f"Execution failed:\n {error}")
+                return
+        else:
+            engine_note = ENGINES[engine].available()[1]
+            if engine_note:
+                st.caption(f"({engine}: {engine_note})")
+            # repeated exploratory queries are served from cache
+            cache_key = SQL_RESULT_CACHE.make_key(db_file, code, variant=engine)
+            df = SQL_RESULT_CACHE.get(cache_key)
+            if df is None:
+                df, timings = _run_explore_query(db_file, code, engine=engine)
+                SQL_RESULT_CACHE.put(cache_key, df)
+                setup_str = f" + {timings['setup_sec']:.3f} sec setup" if timings.get("setup_sec") else ""
+                st.caption(f"({engine}: {timings['exec_sec']:.3f} sec{setup_str})")
+            else:
+                st.caption("(served from result cache)")
+        if save_as in ["parquet", "arrow"]:
+            file_path = save_result(df, fmt=save_as)
+            st.info(f"Saved {len(df)} rows to {file_path}")
+        else:
             st.dataframe(df)
-        elif code.strip().split(" ")[0].lower() in ["create", "insert","update", "delete", "drop"]:
+        return df
+    elif code.strip().split(" ")[0].lower() in ["create", "insert","update", "delete", "drop"]:
+        if explore:
+            st.warning("Write statements are disabled in read-only exploration mode")
+            return
+        with DBConn(db_file) as _conn:
             cur = _conn.cursor()
             cur.executescript(code)
             _conn.commit()
+        SQL_RESULT_CACHE.invalidate(db_file)
 
+def _display_rebuild_sample():
+    """sample is rebuilt automatically on inserts/deletes, in-place UPDATEs need this
+    """
+    if st.button("Rebuild sample DB", key="code_run_rebuild_sample"):
+        try:
+            sample_file = build_sample(CFG["DB_FILE"], SAMPLE_FRACTION, force=True, exclude_tables=APP_TABLES)
+            st.success(f"Rebuilt {sample_file}")
+        except Exception:
+            st.error(format_exc())
 
+def _execute_code_sql_sample(code):
+    """run SELECT on the FK-preserving sample of DB_FILE,
+    show estimated full-size runtime/rows and offer to promote it
+    """
+    try:
+        df, estimate = run_on_sample(CFG["DB_FILE"], code, exclude_tables=APP_TABLES)
+    except (QueryCancelled, QueryTimeout) as e:
+        st.warning(str(e))
+        return
+    except Exception:
+        st.error(f"Execution on sample failed:\n {format_exc()}")
+        return
+    st.dataframe(df)
+    st.session_state.update({"SAMPLE_PENDING_SQL": code, "SAMPLE_ESTIMATE": estimate})
+
+def _display_promote_sample(save_as=None, engine=ENGINE_SQLITE):
+    code = st.session_state.get("SAMPLE_PENDING_SQL")
+    if not code:
+        return
+    estimate = st.session_state.get("SAMPLE_ESTIMATE", {})
+    est_rows_min, est_rows = estimate.get("est_full_rows_min"), estimate.get("est_full_rows")
+    est_rows_str = f"{est_rows}" if est_rows_min in (None, est_rows) else f"{est_rows_min}-{est_rows}"
+    st.info(f"""Sample run: {estimate.get("sample_rows")} rows in {estimate.get("sample_sec", 0):.3f} sec;
+        rough estimate on full DB: ~{est_rows_str} rows in ~{estimate.get("est_full_sec", 0):.1f} sec
+        (x{estimate.get("scale", 1):.1f} by row ratio of {", ".join(estimate.get("tables", []))};
+        sample built {str(estimate.get("sample_built_at", ""))[:19]}, rebuild it if rows were updated)""")
+    c1, _, c2 = st.columns([3,2,3])
+    with c1:
+        btn_promote = st.button("Promote to full database")
+    with c2:
+        btn_discard = st.button("Discard sample run")
+    if btn_promote or btn_discard:
+        st.session_state.pop("SAMPLE_PENDING_SQL", None)
+        st.session_state.pop("SAMPLE_ESTIMATE", None)
+    if btn_promote:
+        _execute_code(code, "sql", save_as=save_as, engine=engine)
 
 def _execute_code_python(code):
     # https://stackoverflow.com/questions/11914472/how-to-use-stringio-in-python3
@@ -571,18 +871,73 @@ def _execute_code_python(code):
     if codeErr and codeErr.getvalue():
         st.error(codeErr.getvalue())
 
-def _execute_code(gen_code, use_case):
+def _execute_code(gen_code, use_case, save_as=None, engine=ENGINE_SQLITE):
     try:
         if use_case == "sql":
-            _execute_code_sql(gen_code)
+            _execute_code_sql(gen_code, save_as=save_as, engine=engine)
             st.info("Execution successful!")              
         elif use_case == "python":
             _execute_code_python(gen_code)
             st.info("Execution successful!")              
         elif use_case == "javascript":
             st.info("You can use browser developer console to validate JavaScript code")
-    except:
+    except (QueryCancelled, QueryTimeout) as e:
+        st.warning(str(e))
+    except Exception:
         st.error(f"Execution failed:\n {format_exc()}")
+def _add_schema_header(prompt_s, top_k=TOP_K):
+    """prepend "Table x, columns = [...]" lines for the top_k tables relevant to the prompt,
+    skipping tables already declared in it
+    """
+    declared = re.findall(r"^\s*Table\s+(\w+)\s*,", prompt_s, flags=re.MULTILINE | re.IGNORECASE)
+    tables = prune_schema(CFG["DB_FILE"], prompt_s, top_k=top_k, exclude_tables=APP_TABLES, known_tables=declared)
+    if not tables:
+        return prompt_s
+    header = schema_header(tables)
+    lines = prompt_s.split("\n")
+    if lines and lines[0].strip() == PROMPT_DELIMITOR:
+        return "\n".join([lines[0], header] + lines[1:])
+    return header + "\n" + prompt_s
+
+def _gen_completion(settings_dict, prompt_str, priority=PRIORITY_INTERACTIVE):
+    """call OpenAI with settings_dict, log request/response and return generated text;
+    no Streamlit calls so it can also run as a background job
+    """
+    # identical requests in flight share one API call
+    response, coalesced = create_completion(
+        priority=priority,
+        model=settings_dict["Model"], 
+        prompt=prompt_str,
+        temperature=settings_dict["Temperature"],
+        max_tokens=settings_dict["Maximum_length"],
+        top_p=settings_dict["Top_p"],
+        frequency_penalty=settings_dict["Frequency_penalty"],
+        presence_penalty=settings_dict["Presence_penalty"]
+    )
+    if coalesced:
+        print("coalesced with an identical in-flight request")
+    resp_str = response["choices"][0]["text"]
+    # tokens are only counted for the caller that made the API call
+    usage = None if coalesced else response.get("usage")
+    _insert_log(use_case=settings_dict["Use_case"], settings=str(settings_dict), prompt=prompt_str, output=resp_str, usage=usage)
+    return resp_str
+
+def _display_job(job):
+    st.write(f"**{job.get('kind')}** `{job.get('uuid')}` - status: **{job.get('status')}**")
+    st.caption(f"submitted: {job.get('ts_submit')}, started: {job.get('ts_start')}, ended: {job.get('ts_end')}")
+    if job.get("error"):
+        st.error(job.get("error"))
+    result = job.get("result")
+    if result is None:
+        return
+    if isinstance(result, pd.DataFrame):
+        st.dataframe(result)
+    else:
+        st.info(result)
+        if job.get("kind") == "completion" and st.button("Use as generated code"):
+            st.session_state["GENERATED_CODE"] = result
+            st.info(f"Generated code updated, see '{_STR_MENU_SQL_GEN_RUN}'")
+
 #####################################################
 # Menu Handlers
 #####################################################
@@ -669,17 +1024,26 @@ def do_code_gen(show_response=True, show_header=True):
         st.info("""For non-code-generation use cases, 
             choose text-davinci-002 model.""")
 
-    c_1, c_2, _, _, _, _ = st.columns(6)
+    c_1, c_2, c_3, _, _, _ = st.columns(6)
     with c_1:
         insert_prompts = st.checkbox(f"insert delimitor {PROMPT_DELIMITOR}", value=True)
     with c_2:
         remove_leading_hash = st.checkbox(f"remove leading #", value=False)
+    with c_3:
+        run_in_background = st.checkbox("run in background", value=False, key="code_gen_background")
 
     prompt_value = EXAMPLE_PROMPT.get(openai_use_case, "")
     if insert_prompts:
         prompt_value = f"{PROMPT_DELIMITOR}\n" + prompt_value + f"\n{PROMPT_DELIMITOR}\n\n\n"    
     prompt = st.text_area(f"Prompt: (example delimitors: {str(PROMPT_LIST)}", value=prompt_value, height=200)
     prompt_s = '\n'.join([i.strip() for i in prompt.split('\n') if i.strip()])
+    add_schema, top_k = False, TOP_K
+    if openai_use_case == "SQL":
+        c_1, c_2, _ = st.columns([2,1,3])
+        with c_1:
+            add_schema = st.checkbox("add relevant tables from DB schema", value=False, key="code_gen_add_schema")
+        with c_2:
+            top_k = st.number_input("top-k tables", min_value=1, max_value=20, value=TOP_K, key="code_gen_top_k")
     # st.write(prompt)
     if st.button("Submit"):
         print(f"model = {openai_model}, use case = {openai_use_case}")
@@ -699,6 +1063,9 @@ def do_code_gen(show_response=True, show_header=True):
             "Presence_penalty": openai_presence_penalty,
         }
 
+        if add_schema:
+            prompt_s = _add_schema_header(prompt_s, top_k=top_k)
+
         if insert_prompts and PROMPT_DELIMITOR not in prompt_s:
             prompt_str = f"{PROMPT_DELIMITOR}\n" + prompt_s + f"\n{PROMPT_DELIMITOR}\n\n\n"
         else:
@@ -707,24 +1074,26 @@ def do_code_gen(show_response=True, show_header=True):
         if remove_leading_hash:
             prompt_str = _remove_leading_hash(prompt_str)
 
+        if add_schema:
+            with st.expander("Prompt with relevant schema:", expanded=False):
+                st.text(prompt_str)
+
         # st.info(settings_dict)
     
+        if run_in_background:
+            job_id = submit_job(CFG["DB_FILE"], "completion", title=f"{openai_use_case}: {prompt_s[:60]}",
+                fn=lambda: _gen_completion(settings_dict, prompt_str, priority=PRIORITY_BATCH))
+            st.info(f"Submitted job {job_id}, check status in '{_STR_MENU_JOBS}'")
+            return
+
         try:
-            response = openai.Completion.create(
-                model=openai_model, 
-                prompt=prompt_str,
-                temperature=openai_temperature,
-                max_tokens=openai_maximum_length,
-                top_p=openai_top_p,
-                frequency_penalty=openai_frequency_penalty,
-                presence_penalty=openai_presence_penalty
-            )
-            resp_str = response["choices"][0]["text"]
+            resp_str = _gen_completion(settings_dict, prompt_str)
             st.session_state["GENERATED_CODE"] = resp_str
-            _insert_log(use_case=openai_use_case, settings=str(settings_dict), prompt=prompt_str, output=resp_str)
             if show_response:
                 st.write("Response:")
                 st.info(resp_str)
+        except RateLimitError:
+            st.warning("OpenAI rate limit still exceeded after retries, please try again later")
         except:
             st.error(format_exc())
 
@@ -759,11 +1128,35 @@ def do_code_run(show_header=True):
         "python" : "Run Python ...",
         "javascript" : "Run JavaScript ...",
     }
+    save_as = None
+    engine = ENGINE_SQLITE
+    sample_first = False
+    run_in_background = False
+    if selected_use_case == "sql":
+        c1, c2 = st.columns([5,5])
+        with c1:
+            save_as = st.selectbox("Result output", RESULT_OUTPUTS, key="code_run_result_output")
+        with c2:
+            engine = st.selectbox("Engine", _engine_options(), key="code_run_engine")
+        sample_first = st.checkbox(f"Run SELECT on {SAMPLE_FRACTION:.0%} sample DB first", value=False, key="code_run_sample_first")
+        if sample_first:
+            _display_rebuild_sample()
+        run_in_background = st.checkbox("Run SELECT in background", value=False, key="code_run_background")
     if gen_code and st.button(btn_label[selected_use_case]):
-        _execute_code(gen_code, selected_use_case)
+        if run_in_background and gen_code.strip().lower().startswith("select"):
+            db_file, bg_engine = CFG["DB_FILE"], (ENGINE_SQLITE if engine == ENGINE_COMPARE else engine)
+            job_id = submit_job(db_file, "sql", title=gen_code.strip()[:60],
+                fn=lambda: timed_query(bg_engine, db_file, gen_code, timeout_sec=BACKGROUND_TIMEOUT_SEC)[0])
+            st.info(f"Submitted job {job_id}, check status in '{_STR_MENU_JOBS}'")
+        elif sample_first and gen_code.strip().lower().startswith("select"):
+            _execute_code_sql_sample(gen_code)
+        else:
+            _execute_code(gen_code, selected_use_case, save_as=save_as, engine=engine)
+    _display_promote_sample(save_as, engine=engine)
 
 def do_sqlite_sample_db():
     st.subheader(f"{_STR_MENU_SQLITE_SAMPLE}")
+    _display_ingest_data()
     tables = _get_tables()
     idx_default = tables.index("customers") if "customers" in tables else 0
     schema_value = st.session_state.get("TABLE_SCHEMA", "")
@@ -771,7 +1164,7 @@ def do_sqlite_sample_db():
     with c1:
         table_name = st.selectbox("Table:", tables, index=idx_default, key="table_name")
         if st.button("Show schema"):
-            with DBConn(CFG["DB_FILE"]) as _conn:
+            with ExploreConn(CFG["DB_FILE"]) as _conn:
                 df_schema = pd.read_sql(f"select sql from sqlite_schema where name = '{table_name}'; ", _conn)
                 schema_value = df_schema["sql"].to_list()[0]
                 st.session_state.update({"TABLE_SCHEMA" : schema_value})
@@ -780,13 +1173,54 @@ def do_sqlite_sample_db():
         st.text_area("Schema:", value=schema_value, height=150)
 
     sql_stmt = st.text_area("SQL:", value=f"select * from {table_name} limit 10;", height=100)
+    c1, c2 = st.columns([5,5])
+    with c1:
+        save_as = st.selectbox("Result output", RESULT_OUTPUTS, key="sample_db_result_output")
+    with c2:
+        engine = st.selectbox("Engine", _engine_options(), key="sample_db_engine")
     if st.button("Execute Query ..."):
         try:
-            _execute_code_sql(code=sql_stmt)
-        except:
+            _execute_code_sql(code=sql_stmt, explore=True, save_as=save_as, engine=engine)
+        except (QueryCancelled, QueryTimeout) as e:
+            st.warning(str(e))
+        except Exception:
             st.error(format_exc())
 
 
+def _display_ingest_data():
+    with st.expander("Load CSV/Parquet file into sample DB:", expanded=False):
+        c1, c2 = st.columns([5,5])
+        with c1:
+            uploaded_file = st.file_uploader("Upload file", type=["csv", "parquet"], key="ingest_upload")
+            file_path = st.text_input("or file path on server (for large files)", value="", key="ingest_file_path")
+        with c2:
+            table_name = st.text_input("Table name", value="", key="ingest_table_name")
+            if_exists = st.selectbox("If table exists", IF_EXISTS_OPTIONS, key="ingest_if_exists")
+            index_columns = st.text_input("Index columns (comma separated)", value="", key="ingest_index_columns")
+        if not st.button("Load data"):
+            return
+        src = file_path.strip() or uploaded_file
+        if not src or not table_name.strip():
+            st.warning("Please provide a file and a table name")
+            return
+        placeholder = st.empty()
+        try:
+            stats = ingest_file(CFG["DB_FILE"], src, table_name,
+                if_exists=if_exists,
+                index_columns=[c.strip() for c in index_columns.split(",") if c.strip()],
+                progress=lambda n, sec: placeholder.caption(f"{n:,} rows loaded, {n/sec if sec else 0:,.0f} rows/sec"),
+                protected_tables=APP_TABLES)
+        except ValueError as e:
+            st.error(str(e))
+            return
+        except Exception:
+            st.error(format_exc())
+            return
+        finally:
+            SQL_RESULT_CACHE.invalidate(CFG["DB_FILE"])
+        st.success(f"Loaded {stats['rows']:,} rows into '{stats['table']}' in {stats['seconds']:.1f} sec ({stats['rows_per_sec']:,.0f} rows/sec)")
+        st.write(stats["columns"])
+
 def do_settings():
     st.subheader(f"{_STR_MENU_SETTINGS}")
 
@@ -820,6 +1254,30 @@ def do_settings():
         st.write(KEY)
 
 
+def do_jobs():
+    st.subheader(f"{_STR_MENU_JOBS}")
+    c1, c2, c3, _ = st.columns([2,3,3,4])
+    with c1:
+        st.button("Refresh", key="jobs_refresh")
+    with c2:
+        auto_refresh = st.checkbox(f"Auto-refresh every {JOB_REFRESH_SEC} sec", value=False, key="jobs_auto_refresh")
+    with c3:
+        if st.button("Clear finished jobs"):
+            delete_finished_jobs(CFG["DB_FILE"])
+
+    df_jobs = select_jobs(CFG["DB_FILE"])
+    grid_response = _display_grid_df(df_jobs, selection_mode="single", page_size=10, grid_height=370, lightweight=True)
+    if grid_response:
+        selected_rows = grid_response['selected_rows']
+        if selected_rows:
+            job = get_job(CFG["DB_FILE"], selected_rows[0].get("uuid"))
+            if job is not None:
+                _display_job(job)
+
+    if auto_refresh and (df_jobs["status"].isin([JOB_QUEUED, JOB_RUNNING])).any():
+        time.sleep(JOB_REFRESH_SEC)
+        (getattr(st, "rerun", None) or st.experimental_rerun)()
+
 def do_notes():
     st.subheader(f"{_STR_MENU_NOTES}")
     _display_grid_notes()
@@ -835,6 +1293,7 @@ menu_dict = {
     # _STR_MENU_SQL_GEN:               {"fn": do_code_gen},
     # _STR_MENU_SQL_RUN:               {"fn": do_code_run},
     _STR_MENU_SQLITE_SAMPLE:         {"fn": do_sqlite_sample_db},
+    _STR_MENU_JOBS:                  {"fn": do_jobs},
     _STR_MENU_SETTINGS:              {"fn": do_settings},
     _STR_MENU_NOTES:                 {"fn": do_notes},
 }
@@ -853,16 +1312,54 @@ def do_sidebar():
         if menu_item in menu_options:
             pass
 
+        if st.checkbox("Profile reruns", value=False, key="profile_reruns"):
+            st.checkbox("Dump cProfile stats", value=False, key="profile_cprofile")
+
 # body
 def do_body():
     menu_item = st.session_state.get("menu_item", _STR_MENU_HOME)
     menu_dict[menu_item]["fn"]()
 
+## profiling (opt-in from sidebar)
+def _setup_profiling():
+    """wrap menu handlers and DB helpers for this rerun,
+    the script is re-executed on every rerun so wrappers never stack
+    """
+    if not st.session_state.get("profile_reruns"):
+        return None
+    profiler = st.session_state.setdefault("PROFILER", Profiler())
+    profiler.start_rerun(label=st.session_state.get("menu_item", _STR_MENU_HOME))
+    g = globals()
+    for name in PROFILED_SQL_FNS:
+        g[name] = profiler.wrap(g[name], kind=KIND_SQL)
+    for name in PROFILED_UI_FNS:
+        g[name] = profiler.wrap(g[name], kind=KIND_UI)
+    for item in menu_dict.values():
+        name = item["fn"].__name__
+        g[name] = item["fn"] = profiler.wrap(g[name], kind=KIND_UI)
+    return profiler
+
+def _display_profiling(profiler, rerun):
+    with st.expander(f"Profiling (last {len(profiler.reruns)} reruns):", expanded=False):
+        st.write(f"This rerun: wall = {rerun['wall_sec']:.3f} sec, SQL = {rerun['sql_sec']:.3f} sec, rows = {rerun['rows']}")
+        st.dataframe(pd.DataFrame(rerun["calls"]))
+        st.write("Recent reruns:")
+        st.dataframe(pd.DataFrame(profiler.summary()))
+        if rerun.get("pstats_file"):
+            st.write(f"cProfile stats: {rerun['pstats_file']}")
+            st.text(pstats_top(rerun["pstats_file"]))
+
 def main():
+    profiler = _setup_profiling()
     _load_settings()
     # st.write(CFG)    
     do_sidebar()
-    do_body()
+    if profiler is not None and st.session_state.get("profile_cprofile"):
+        profiler.run_cprofile(do_body)
+    else:
+        do_body()
+    if profiler is not None:
+        _display_profiling(profiler, profiler.end_rerun())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,171 @@
+"""
+Process-wide wrapper around openai.Completion.create
+
+- identical in-flight requests (same model, prompt and settings) are coalesced:
+  the first caller makes the API call, later callers wait on its future
+- calls are admitted by per-model token buckets (requests and tokens per minute),
+  lower priority value first, so interactive requests get ahead of batch jobs
+- rate-limit and transient API errors are retried with jittered exponential backoff
+- lives in its own module so the in-flight table and scheduler are shared across
+  Streamlit sessions and reruns
+"""
+from concurrent.futures import Future
+from itertools import count
+from threading import Condition, Lock
+import heapq
+import random
+import time
+
+import openai
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+# model -> (requests per minute, tokens per minute)
+RATE_LIMITS = {
+    "code-davinci-002": (20, 40000),
+    "text-davinci-003": (60, 150000),
+    "text-davinci-002": (60, 150000),
+}
+DEFAULT_RATE_LIMIT = (60, 150000)
+
+MAX_RETRIES = 5
+BACKOFF_BASE_SEC = 1.0
+BACKOFF_MAX_SEC = 60.0
+
+_OPENAI_ERROR = getattr(openai, "error", None)
+RateLimitError = getattr(_OPENAI_ERROR, "RateLimitError", ())
+_RETRYABLE_ERRORS = tuple(
+    getattr(_OPENAI_ERROR, name)
+    for name in ["RateLimitError", "APIError", "Timeout", "ServiceUnavailableError", "APIConnectionError"]
+    if hasattr(_OPENAI_ERROR, name)
+)
+
+_INFLIGHT = dict()     # request key -> Future
+_INFLIGHT_LOCK = Lock()
+
+
+class TokenBucket(object):
+    """refills at rate_per_min, holds at most one minute worth of capacity
+    """
+    def __init__(self, rate_per_min):
+        self.capacity = float(rate_per_min)
+        self.rate_per_sec = rate_per_min / 60.0
+        self.level = self.capacity
+        self.ts = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.ts) * self.rate_per_sec)
+        self.ts = now
+
+    def wait_time(self, amount, now):
+        """seconds until amount is available (0 if available now)
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate_per_sec
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+
+class ModelScheduler(object):
+    """admit calls to one model in priority order under RPM/TPM limits
+    """
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._waiters = []        # heap of (priority, seq)
+        self._seq = count()
+        self._cond = Condition()
+
+    def acquire(self, n_tokens, priority=PRIORITY_INTERACTIVE):
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    if self._waiters[0] == ticket:
+                        now = time.monotonic()
+                        delay = max(self.requests.wait_time(1, now), self.tokens.wait_time(n_tokens, now))
+                        if delay <= 0:
+                            self.requests.take(1)
+                            self.tokens.take(n_tokens)
+                            return
+                        self._cond.wait(timeout=delay)
+                    else:
+                        self._cond.wait()
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+
+_SCHEDULERS = dict()   # model -> ModelScheduler
+_SCHEDULERS_LOCK = Lock()
+
+def _get_scheduler(model):
+    with _SCHEDULERS_LOCK:
+        if model not in _SCHEDULERS:
+            _SCHEDULERS[model] = ModelScheduler(*RATE_LIMITS.get(model, DEFAULT_RATE_LIMIT))
+        return _SCHEDULERS[model]
+
+def _estimate_tokens(params):
+    """rough token count: ~4 chars per prompt token plus max_tokens of output
+    """
+    return len(str(params.get("prompt", ""))) // 4 + int(params.get("max_tokens") or 16)
+
+def _backoff_sec(attempt):
+    return random.uniform(0, min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * (2 ** attempt)))
+
+def _scheduled_create(params, priority):
+    scheduler = _get_scheduler(params.get("model"))
+    n_tokens = _estimate_tokens(params)
+    for attempt in range(MAX_RETRIES + 1):
+        scheduler.acquire(n_tokens, priority=priority)
+        try:
+            return openai.Completion.create(**params)
+        except _RETRYABLE_ERRORS as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            delay = _backoff_sec(attempt)
+            print(f"OpenAI call failed ({type(e).__name__}), retry {attempt+1}/{MAX_RETRIES} in {delay:.1f} sec")
+            time.sleep(delay)
+
+def _request_key(params):
+    return tuple(sorted((k, repr(v)) for k, v in params.items()))
+
+def create_completion(priority=PRIORITY_INTERACTIVE, **params):
+    """call openai.Completion.create(**params) through the scheduler,
+    sharing the result with any identical request already in flight.
+
+    return (response, coalesced) where coalesced is True if this caller
+    did not make its own API call
+    """
+    key = _request_key(params)
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _INFLIGHT[key] = future
+
+    if not is_leader:
+        return future.result(), True
+
+    try:
+        response = _scheduled_create(params, priority)
+        future.set_result(response)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+    return response, False
+
+def inflight_count():
+    with _INFLIGHT_LOCK:
+        return len(_INFLIGHT)
@@ -2,11 +2,19 @@
 # coding: utf-8
 
 # Merge `GPT-3 log` data between 2 sqlite databases
+#
+# Target rows are deleted and appended with plain SQL, so the usage triggers
+# (see log_usage.py) apply the same deltas as edits made in the app.
 
+from os.path import abspath, dirname
 import sys
 import sqlite3
 import pandas as pd
 
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from log_schema import migrate, backfill
+from log_usage import ensure_usage
+
 DELIMITOR = ","
 
 class DBConn(object):
@@ -30,7 +38,11 @@ def list2sql_str(l):
     return str(l).replace("[", "(").replace("]", ")")
 
 def merge_logs(src_db, tgt_db="gpt3sql.sqlite", table_name="t_gpt3_log"):
-    
+
+    # typed columns and usage triggers must exist in tgt before rows are moved
+    migrate(tgt_db, table_name)
+    ensure_usage(tgt_db)
+
     df_src = get_data(src_db, table_name)
     df_tgt = get_data(tgt_db, table_name)
 
@@ -61,6 +73,9 @@ def merge_logs(src_db, tgt_db="gpt3sql.sqlite", table_name="t_gpt3_log"):
             df_src.to_sql(table_name, _conn, if_exists='append', index=False)
             _conn.commit()  
 
+        # rows from a src without typed columns
+        backfill(tgt_db, table_name)
+
     return uuid_update
 
 
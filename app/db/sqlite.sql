@@ -45,4 +45,62 @@ FROM
     sqlite_schema
 WHERE 
     type ='table' AND 
-    name NOT LIKE 'sqlite_%';
\ No newline at end of file
+    name NOT LIKE 'sqlite_%';
+
+-- background jobs (created on demand by jobs.py)
+create table if not exists t_job (
+	uuid  TEXT NOT NULL,
+	ts_submit text,
+	ts_start text,
+	ts_end text,
+	kind text,
+	title text,
+	status text,
+	result_format text,
+	result text,
+	error text
+);
+create unique index if not exists idx_job on t_job(uuid);
+create index if not exists idx_job_ts_submit on t_job(ts_submit);
+
+
+-- typed log columns (added and backfilled by log_schema.migrate)
+alter table t_gpt3_log add column ts_epoch REAL;
+alter table t_gpt3_log add column model TEXT;
+alter table t_gpt3_log add column temperature REAL;
+alter table t_gpt3_log add column max_tokens INTEGER;
+alter table t_gpt3_log add column prompt_tokens INTEGER;
+alter table t_gpt3_log add column completion_tokens INTEGER;
+create index if not exists idx_gpt3_log_ts on t_gpt3_log(ts_epoch);
+create index if not exists idx_gpt3_log_use_case_ts on t_gpt3_log(use_case, ts_epoch);
+create index if not exists idx_gpt3_log_model_ts on t_gpt3_log(model, ts_epoch);
+
+
+-- daily usage aggregates maintained by triggers (created and rebuilt by log_usage.ensure_usage)
+create table if not exists t_gpt3_log_usage (
+	day text not null,
+	use_case text not null,
+	model text not null,
+	n_prompts integer not null default 0,
+	n_validated integer not null default 0,
+	prompt_tokens integer not null default 0,
+	completion_tokens integer not null default 0,
+	primary key (day, use_case, model)
+);
+create trigger if not exists trg_gpt3_log_usage_ins after insert on t_gpt3_log
+begin
+	insert or ignore into t_gpt3_log_usage (day, use_case, model) values (substr(coalesce(NEW.ts, ''), 1, 10), coalesce(NEW.use_case, ''), coalesce(NEW.model, ''));
+	update t_gpt3_log_usage set n_prompts = n_prompts + 1, n_validated = n_validated + (coalesce(NEW.valid_output, '') != ''), prompt_tokens = prompt_tokens + coalesce(NEW.prompt_tokens, 0), completion_tokens = completion_tokens + coalesce(NEW.completion_tokens, 0) where day = substr(coalesce(NEW.ts, ''), 1, 10) and use_case = coalesce(NEW.use_case, '') and model = coalesce(NEW.model, '');
+end;
+create trigger if not exists trg_gpt3_log_usage_del after delete on t_gpt3_log
+begin
+	update t_gpt3_log_usage set n_prompts = n_prompts - 1, n_validated = n_validated - (coalesce(OLD.valid_output, '') != ''), prompt_tokens = prompt_tokens - coalesce(OLD.prompt_tokens, 0), completion_tokens = completion_tokens - coalesce(OLD.completion_tokens, 0) where day = substr(coalesce(OLD.ts, ''), 1, 10) and use_case = coalesce(OLD.use_case, '') and model = coalesce(OLD.model, '');
+	delete from t_gpt3_log_usage where day = substr(coalesce(OLD.ts, ''), 1, 10) and use_case = coalesce(OLD.use_case, '') and model = coalesce(OLD.model, '') and n_prompts <= 0;
+end;
+create trigger if not exists trg_gpt3_log_usage_upd after update of ts, use_case, model, valid_output, prompt_tokens, completion_tokens on t_gpt3_log
+begin
+	update t_gpt3_log_usage set n_prompts = n_prompts - 1, n_validated = n_validated - (coalesce(OLD.valid_output, '') != ''), prompt_tokens = prompt_tokens - coalesce(OLD.prompt_tokens, 0), completion_tokens = completion_tokens - coalesce(OLD.completion_tokens, 0) where day = substr(coalesce(OLD.ts, ''), 1, 10) and use_case = coalesce(OLD.use_case, '') and model = coalesce(OLD.model, '');
+	delete from t_gpt3_log_usage where day = substr(coalesce(OLD.ts, ''), 1, 10) and use_case = coalesce(OLD.use_case, '') and model = coalesce(OLD.model, '') and n_prompts <= 0;
+	insert or ignore into t_gpt3_log_usage (day, use_case, model) values (substr(coalesce(NEW.ts, ''), 1, 10), coalesce(NEW.use_case, ''), coalesce(NEW.model, ''));
+	update t_gpt3_log_usage set n_prompts = n_prompts + 1, n_validated = n_validated + (coalesce(NEW.valid_output, '') != ''), prompt_tokens = prompt_tokens + coalesce(NEW.prompt_tokens, 0), completion_tokens = completion_tokens + coalesce(NEW.completion_tokens, 0) where day = substr(coalesce(NEW.ts, ''), 1, 10) and use_case = coalesce(NEW.use_case, '') and model = coalesce(NEW.model, '');
+end;
@@ -0,0 +1,24 @@
+"""
+Helpers shared by the database modules (standard library only)
+
+- TABLE_GPT3_LOG: name of `GPT-3 log` table
+- quote_ident: quote a SQLite identifier (table/column/index name)
+- parse_settings: parse the `settings` column saved as str(dict)
+"""
+from ast import literal_eval
+
+TABLE_GPT3_LOG = "t_gpt3_log"
+
+def quote_ident(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def parse_settings(settings):
+    """parse settings saved as str(dict) into a dict, {} if unparsable
+    """
+    if not settings:
+        return {}
+    try:
+        val = literal_eval(settings)
+    except (ValueError, SyntaxError):
+        return {}
+    return val if isinstance(val, dict) else {}
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Bulk load CSV/Parquet files into a SQLite database
+
+- files are streamed in chunks, never loaded whole into memory
+- column types are inferred from a sample of the first rows
+- rows go in via executemany inside large transactions, into a uniquely named
+  staging table; the target table is only replaced/appended to in one final
+  transaction, so a bad file never leaves a dropped or half-loaded table
+- indexes are created after the load
+- tables listed in protected_tables (the app's own tables) are never dropped or written
+
+Usage:
+    python ingest_data.py <file.csv|file.parquet> <table_name> [db_file] [index_col,...]
+"""
+from io import TextIOWrapper
+from itertools import chain, islice
+from uuid import uuid4
+from os.path import splitext
+import csv
+import re
+import sqlite3
+import sys
+import time
+
+from db_common import quote_ident
+
+CHUNK_ROWS = 10000          # rows per executemany
+TXN_ROWS = 200000           # rows per transaction
+SAMPLE_ROWS = 1000          # rows used for type inference
+
+IF_EXISTS_OPTIONS = ["fail", "append", "replace"]
+
+_RE_INT = re.compile(r"^[-+]?\d+$")
+_RE_REAL = re.compile(r"^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$")
+
+def clean_table_name(name):
+    name = re.sub(r"\W", "_", str(name).strip())
+    return f"t_{name}" if not name or name[0].isdigit() else name
+
+def infer_type(values):
+    """INTEGER/REAL/TEXT from sample string values, empty values ignored
+    """
+    values = [v for v in values if v not in (None, "")]
+    if not values:
+        return "TEXT"
+    if all(_RE_INT.match(v) for v in values):
+        return "INTEGER"
+    if all(_RE_REAL.match(v) for v in values):
+        return "REAL"
+    return "TEXT"
+
+def _arrow_type(field_type):
+    import pyarrow as pa
+    if pa.types.is_integer(field_type) or pa.types.is_boolean(field_type):
+        return "INTEGER"
+    if pa.types.is_floating(field_type) or pa.types.is_decimal(field_type):
+        return "REAL"
+    return "TEXT"
+
+def _csv_source(f, encoding="utf-8-sig"):
+    """return (columns, types, row iterator) for a binary/text file object
+    """
+    if not hasattr(f, "encoding"):
+        f = TextIOWrapper(f, encoding=encoding, newline="")
+    reader = csv.reader(f)
+    columns = next(reader)
+    sample = list(islice(reader, SAMPLE_ROWS))
+    types = [infer_type([r[i] if i < len(r) else None for r in sample]) for i in range(len(columns))]
+    n_cols = len(columns)
+
+    def _rows():
+        for r in chain(sample, reader):
+            # empty string -> NULL, pad/truncate ragged rows; column affinity converts numbers
+            r = [v if v != "" else None for v in r[:n_cols]]
+            yield r + [None] * (n_cols - len(r))
+    return columns, types, _rows()
+
+def _parquet_source(f):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("pyarrow is required to load Parquet files: pip install pyarrow")
+    pf = pq.ParquetFile(f)
+    schema = pf.schema_arrow
+    columns = schema.names
+    types = [_arrow_type(field.type) for field in schema]
+
+    def _value(v):
+        return v if v is None or isinstance(v, (int, float, str, bytes)) else str(v)
+
+    def _rows():
+        for batch in pf.iter_batches(batch_size=CHUNK_ROWS):
+            cols = [batch.column(i).to_pylist() for i in range(batch.num_columns)]
+            for row in zip(*cols):
+                yield [_value(v) for v in row]
+    return columns, types, _rows()
+
+def _table_exists(conn, table_name):
+    return conn.execute("select 1 from sqlite_schema where type='table' and name = ? collate nocase;",
+        (table_name,)).fetchone() is not None
+
+def _file_format(file_name):
+    ext = splitext(str(file_name))[1].lower()
+    return "parquet" if ext in [".parquet", ".pq"] else "csv"
+
+def ingest_file(db_file, f, table_name, file_format=None, if_exists="fail",
+        index_columns=(), progress=None, protected_tables=()):
+    """stream f (path or file object) into table_name, return stats dict
+
+    progress(rows_loaded, elapsed_sec) is called after every chunk,
+    ValueError if table_name is one of protected_tables or a sqlite_ internal table
+    """
+    table_name = clean_table_name(table_name)
+    if table_name.lower() in {t.lower() for t in protected_tables} or table_name.lower().startswith("sqlite_"):
+        raise ValueError(f"Table {table_name} is reserved (app or SQLite internal table), choose another table name")
+
+    file_format = file_format or _file_format(getattr(f, "name", f))
+    if isinstance(f, str) and file_format == "csv":
+        with open(f, newline="", encoding="utf-8-sig") as f_csv:
+            return ingest_file(db_file, f_csv, table_name, file_format, if_exists, index_columns, progress, protected_tables)
+    if file_format == "parquet":
+        columns, types, rows = _parquet_source(f)
+    else:
+        columns, types, rows = _csv_source(f)
+
+    ts_start = time.monotonic()
+    n_rows = 0
+    staging = f"_ingest_{table_name}_{uuid4().hex[:8]}"
+    conn = sqlite3.connect(db_file, timeout=30)
+    conn.isolation_level = None     # transactions are managed explicitly below
+    try:
+        if if_exists == "fail" and _table_exists(conn, table_name):
+            raise ValueError(f"Table {table_name} already exists")
+        col_defs = ", ".join(f"{quote_ident(c)} {t}" for c, t in zip(columns, types))
+        conn.execute(f"create table {quote_ident(staging)} ({col_defs});")
+
+        insert_sql = f"insert into {quote_ident(staging)} values ({', '.join(['?'] * len(columns))});"
+        conn.execute("PRAGMA cache_size = -65536;")   # 64MB page cache during load
+        conn.execute("begin;")
+        rows_in_txn = 0
+        while True:
+            chunk = list(islice(rows, CHUNK_ROWS))
+            if not chunk:
+                break
+            conn.executemany(insert_sql, chunk)
+            n_rows += len(chunk)
+            rows_in_txn += len(chunk)
+            if rows_in_txn >= TXN_ROWS:
+                conn.execute("commit;")
+                conn.execute("begin;")
+                rows_in_txn = 0
+            if progress:
+                progress(n_rows, time.monotonic() - ts_start)
+        conn.execute("commit;")
+
+        # swap staging into place in one transaction
+        conn.execute("begin immediate;")
+        exists_ = _table_exists(conn, table_name)
+        if exists_ and if_exists == "fail":
+            raise ValueError(f"Table {table_name} already exists")
+        if exists_ and if_exists == "append":
+            col_list = ", ".join(quote_ident(c) for c in columns)
+            conn.execute(f"insert into {quote_ident(table_name)} ({col_list}) select {col_list} from {quote_ident(staging)};")
+            conn.execute(f"drop table {quote_ident(staging)};")
+        else:
+            if exists_:
+                conn.execute(f"drop table {quote_ident(table_name)};")
+            conn.execute(f"alter table {quote_ident(staging)} rename to {quote_ident(table_name)};")
+        # indexes after load are much cheaper than maintaining them per insert
+        for col in index_columns:
+            conn.execute(f"create index if not exists {quote_ident(f'idx_{table_name}_{col}')} on {quote_ident(table_name)}({quote_ident(col)});")
+        conn.execute("commit;")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("rollback;")
+        conn.execute(f"drop table if exists {quote_ident(staging)};")
+        raise
+    finally:
+        conn.close()
+
+    elapsed = time.monotonic() - ts_start
+    return {
+        "table": table_name,
+        "columns": dict(zip(columns, types)),
+        "rows": n_rows,
+        "seconds": elapsed,
+        "rows_per_sec": n_rows / elapsed if elapsed else 0,
+    }
+
+
+if __name__ == "__main__":
+    from db_common import TABLE_GPT3_LOG
+    from jobs import TABLE_JOBS
+    from log_usage import TABLE_USAGE
+    if len(sys.argv) > 2:
+        file_name, table_name = sys.argv[1], sys.argv[2]
+        db_file = sys.argv[3] if len(sys.argv) > 3 else "db/gpt3sql.sqlite"
+        index_columns = [c for c in sys.argv[4].split(",") if c] if len(sys.argv) > 4 else []
+        try:
+            stats = ingest_file(db_file, file_name, table_name, index_columns=index_columns,
+                protected_tables=[TABLE_GPT3_LOG, "t_resource", TABLE_JOBS, TABLE_USAGE],
+                progress=lambda n, sec: print(f"\r{n:,} rows, {n/sec if sec else 0:,.0f} rows/sec", end=""))
+        except ValueError as e:
+            print(f"[Error] {e}")
+            sys.exit(1)
+        print(f"\nLoaded {stats['rows']:,} rows into '{stats['table']}' in {stats['seconds']:.1f} sec ({stats['rows_per_sec']:,.0f} rows/sec)")
+    else:
+        print("[Error] usage: python ingest_data.py <file.csv|file.parquet> <table_name> [db_file] [index_col,...]")
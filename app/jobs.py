@@ -0,0 +1,135 @@
+"""
+Background jobs for long completions and query executions
+
+- work runs on a process-wide thread pool, so a Streamlit rerun
+  (or moving to another page) does not throw it away
+- job state and results are stored in SQLite (TABLE_JOBS in DB_FILE),
+  the UI polls them by job id
+- job functions must not call Streamlit, they return a str or a DataFrame
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import StringIO
+from threading import Lock
+from traceback import format_exc
+from uuid import uuid4
+import sqlite3
+
+import pandas as pd
+
+TABLE_JOBS = "t_job"
+MAX_WORKERS = 4
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_INTERRUPTED = "interrupted"
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="jobs")
+_INIT_LOCK = Lock()
+_INITIALIZED = set()      # db files with job table ready
+
+class DBConn(object):
+    def __init__(self, db_file):
+        self.conn = sqlite3.connect(db_file, timeout=30)
+    def __enter__(self):
+        return self.conn
+    def __exit__(self, type, value, traceback):
+        self.conn.close()
+
+def _init_db(db_file):
+    """create job table once per process, jobs left queued/running by a
+    previous process can never finish, mark them interrupted
+    """
+    with _INIT_LOCK:
+        if db_file in _INITIALIZED:
+            return
+        with DBConn(db_file) as _conn:
+            _conn.executescript(f"""
+                create table if not exists {TABLE_JOBS} (
+                    uuid  TEXT NOT NULL,
+                    ts_submit text,
+                    ts_start text,
+                    ts_end text,
+                    kind text,
+                    title text,
+                    status text,
+                    result_format text,
+                    result text,
+                    error text
+                );
+                create unique index if not exists idx_job on {TABLE_JOBS}(uuid);
+                create index if not exists idx_job_ts_submit on {TABLE_JOBS}(ts_submit);
+            """)
+            _conn.execute(f"""
+                update {TABLE_JOBS} set status = ?, ts_end = ?
+                where status in (?, ?) ;
+            """, (JOB_INTERRUPTED, str(datetime.now()), JOB_QUEUED, JOB_RUNNING))
+            _conn.commit()
+        _INITIALIZED.add(db_file)
+
+def _update_job(db_file, job_id, **cols):
+    set_clause = ", ".join(f"{col} = ?" for col in cols)
+    with DBConn(db_file) as _conn:
+        _conn.execute(f"update {TABLE_JOBS} set {set_clause} where uuid = ? ;",
+            list(cols.values()) + [job_id])
+        _conn.commit()
+
+def _run_job(db_file, job_id, fn):
+    _update_job(db_file, job_id, status=JOB_RUNNING, ts_start=str(datetime.now()))
+    try:
+        result = fn()
+    except Exception:
+        _update_job(db_file, job_id, status=JOB_FAILED, ts_end=str(datetime.now()), error=format_exc())
+        return
+    if isinstance(result, pd.DataFrame):
+        result_format, result = "dataframe", result.to_json(orient="split", date_format="iso")
+    else:
+        result_format, result = "text", str(result)
+    _update_job(db_file, job_id, status=JOB_DONE, ts_end=str(datetime.now()),
+        result_format=result_format, result=result)
+
+def submit_job(db_file, kind, title, fn):
+    """queue fn() on the background pool, return job id
+    """
+    _init_db(db_file)
+    job_id = str(uuid4())
+    with DBConn(db_file) as _conn:
+        _conn.execute(f"""
+            insert into {TABLE_JOBS} (uuid, ts_submit, kind, title, status)
+            values (?, ?, ?, ?, ?) ;
+        """, (job_id, str(datetime.now()), kind, title, JOB_QUEUED))
+        _conn.commit()
+    _EXECUTOR.submit(_run_job, db_file, job_id, fn)
+    return job_id
+
+def select_jobs(db_file, limit=100):
+    _init_db(db_file)
+    with DBConn(db_file) as _conn:
+        return pd.read_sql(f"""
+            select ts_submit,kind,title,status,ts_start,ts_end,uuid
+            from {TABLE_JOBS}
+            order by ts_submit desc
+            limit {int(limit)} ;
+        """, _conn)
+
+def get_job(db_file, job_id):
+    """return job row as dict, result decoded to str or DataFrame
+    """
+    _init_db(db_file)
+    with DBConn(db_file) as _conn:
+        df = pd.read_sql(f"select * from {TABLE_JOBS} where uuid = ? ;", _conn, params=(job_id,))
+    if not len(df):
+        return None
+    job = {k: (None if pd.isna(v) else v) for k, v in df.to_dict("records")[0].items()}
+    if job.get("result_format") == "dataframe" and job.get("result"):
+        job["result"] = pd.read_json(StringIO(job["result"]), orient="split")
+    return job
+
+def delete_finished_jobs(db_file):
+    _init_db(db_file)
+    with DBConn(db_file) as _conn:
+        _conn.execute(f"delete from {TABLE_JOBS} where status in (?, ?, ?) ;",
+            (JOB_DONE, JOB_FAILED, JOB_INTERRUPTED))
+        _conn.commit()
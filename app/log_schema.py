@@ -0,0 +1,120 @@
+"""
+Typed columns and indexes for `GPT-3 log` table
+
+- ts_epoch (unix seconds), model, temperature, max_tokens,
+  prompt_tokens, completion_tokens are added next to the original text columns
+- indexes on (ts_epoch), (use_case, ts_epoch), (model, ts_epoch)
+- existing rows are backfilled in batches by parsing `ts` and `settings`
+- migration is idempotent and runs once per process per database file
+"""
+from datetime import datetime
+from threading import Lock
+import sqlite3
+
+from db_common import parse_settings, TABLE_GPT3_LOG
+
+BACKFILL_BATCH_SIZE = 1000
+
+# column -> type
+TYPED_COLUMNS = {
+    "ts_epoch": "REAL",
+    "model": "TEXT",
+    "temperature": "REAL",
+    "max_tokens": "INTEGER",
+    "prompt_tokens": "INTEGER",
+    "completion_tokens": "INTEGER",
+}
+
+INDEXES = {
+    "idx_gpt3_log_ts": "(ts_epoch)",
+    "idx_gpt3_log_use_case_ts": "(use_case, ts_epoch)",
+    "idx_gpt3_log_model_ts": "(model, ts_epoch)",
+}
+
+_MIGRATED = set()
+_MIGRATE_LOCK = Lock()
+
+def ts_epoch(ts):
+    """parse ts saved as str(datetime.now()) into unix seconds, None if unparsable
+    """
+    if not ts:
+        return None
+    try:
+        return datetime.fromisoformat(str(ts).strip()).timestamp()
+    except ValueError:
+        return None
+
+def typed_values(ts, settings):
+    """return dict of typed column values parsed from ts and settings strings
+    """
+    d = parse_settings(settings)
+    def _num(key, type_):
+        try:
+            return type_(d[key]) if d.get(key) is not None else None
+        except (TypeError, ValueError):
+            return None
+    return {
+        "ts_epoch": ts_epoch(ts),
+        "model": d.get("Model"),
+        "temperature": _num("Temperature", float),
+        "max_tokens": _num("Maximum_length", int),
+    }
+
+def _backfill(conn, table_name):
+    """parse ts/settings of rows not yet backfilled, BACKFILL_BATCH_SIZE rows per transaction
+    """
+    last_rowid = 0
+    n_rows = 0
+    while True:
+        rows = conn.execute(f"""
+            select rowid, ts, settings from {table_name}
+            where rowid > ? and ts_epoch is null and model is null
+            order by rowid limit ? ;
+        """, (last_rowid, BACKFILL_BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for rowid, ts, settings in rows:
+            v = typed_values(ts, settings)
+            updates.append((v["ts_epoch"], v["model"], v["temperature"], v["max_tokens"], rowid))
+        conn.executemany(f"""
+            update {table_name}
+            set ts_epoch = ?, model = ?, temperature = ?, max_tokens = ?
+            where rowid = ? ;
+        """, updates)
+        conn.commit()
+        last_rowid = rows[-1][0]
+        n_rows += len(rows)
+    return n_rows
+
+def backfill(db_file, table_name=TABLE_GPT3_LOG):
+    """backfill typed columns of rows written without them (e.g. merged from an older DB)
+    """
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        return _backfill(conn, table_name)
+    finally:
+        conn.close()
+
+def migrate(db_file, table_name=TABLE_GPT3_LOG):
+    """add typed columns and indexes, then backfill; return number of rows backfilled
+    """
+    with _MIGRATE_LOCK:
+        if (db_file, table_name) in _MIGRATED:
+            return 0
+        conn = sqlite3.connect(db_file, timeout=30)
+        try:
+            existing = {r[1].lower() for r in conn.execute(f"PRAGMA table_info({table_name});")}
+            if not existing:
+                return 0
+            for col, type_ in TYPED_COLUMNS.items():
+                if col not in existing:
+                    conn.execute(f"alter table {table_name} add column {col} {type_};")
+            for idx, cols in INDEXES.items():
+                conn.execute(f"create index if not exists {idx} on {table_name}{cols};")
+            conn.commit()
+            n_rows = _backfill(conn, table_name)
+        finally:
+            conn.close()
+        _MIGRATED.add((db_file, table_name))
+        return n_rows
@@ -0,0 +1,134 @@
+"""
+Incrementally maintained usage aggregates of `GPT-3 log`
+
+- TABLE_USAGE holds counts per (day, use_case, model): prompts, validated outputs, tokens
+- triggers on insert/update/delete of log rows apply the deltas, so any writer
+  (the app, merge_db.py, plain SQL) keeps the aggregates current
+- the table is rebuilt from the log once, when it is first created
+"""
+from threading import Lock
+import sqlite3
+
+import pandas as pd
+
+from db_common import TABLE_GPT3_LOG
+
+TABLE_USAGE = "t_gpt3_log_usage"
+
+_READY = set()
+_READY_LOCK = Lock()
+
+# key and measure expressions over a log row, prefixed with NEW./OLD. in triggers
+_KEY_EXPR = {
+    "day": "substr(coalesce({r}ts, ''), 1, 10)",
+    "use_case": "coalesce({r}use_case, '')",
+    "model": "coalesce({r}model, '')",
+}
+_MEASURE_EXPR = {
+    "n_prompts": "1",
+    "n_validated": "(coalesce({r}valid_output, '') != '')",
+    "prompt_tokens": "coalesce({r}prompt_tokens, 0)",
+    "completion_tokens": "coalesce({r}completion_tokens, 0)",
+}
+
+def _apply_delta_sql(r, sign):
+    """statements adding (sign=+1) or removing (sign=-1) row r (NEW./OLD.) to aggregates
+    """
+    keys = {k: e.format(r=r) for k, e in _KEY_EXPR.items()}
+    where = " and ".join(f"{k} = {e}" for k, e in keys.items())
+    set_clause = ", ".join(f"{m} = {m} {'+' if sign > 0 else '-'} {e.format(r=r)}"
+        for m, e in _MEASURE_EXPR.items())
+    stmts = []
+    if sign > 0:
+        stmts.append(f"insert or ignore into {TABLE_USAGE} ({', '.join(keys)}) values ({', '.join(keys.values())});")
+    stmts.append(f"update {TABLE_USAGE} set {set_clause} where {where};")
+    if sign < 0:
+        stmts.append(f"delete from {TABLE_USAGE} where {where} and n_prompts <= 0;")
+    return "\n            ".join(stmts)
+
+def _ddl():
+    watched = "ts, use_case, model, valid_output, prompt_tokens, completion_tokens"
+    return f"""
+        create table if not exists {TABLE_USAGE} (
+            day text not null,
+            use_case text not null,
+            model text not null,
+            n_prompts integer not null default 0,
+            n_validated integer not null default 0,
+            prompt_tokens integer not null default 0,
+            completion_tokens integer not null default 0,
+            primary key (day, use_case, model)
+        );
+        create trigger if not exists trg_gpt3_log_usage_ins after insert on {TABLE_GPT3_LOG}
+        begin
+            {_apply_delta_sql("NEW.", +1)}
+        end;
+        create trigger if not exists trg_gpt3_log_usage_del after delete on {TABLE_GPT3_LOG}
+        begin
+            {_apply_delta_sql("OLD.", -1)}
+        end;
+        create trigger if not exists trg_gpt3_log_usage_upd after update of {watched} on {TABLE_GPT3_LOG}
+        begin
+            {_apply_delta_sql("OLD.", -1)}
+            {_apply_delta_sql("NEW.", +1)}
+        end;
+    """
+
+def rebuild_usage(conn):
+    """recompute aggregates from the full log
+    """
+    keys = {k: e.format(r="") for k, e in _KEY_EXPR.items()}
+    measures = {m: e.format(r="") for m, e in _MEASURE_EXPR.items()}
+    conn.execute(f"delete from {TABLE_USAGE};")
+    conn.execute(f"""
+        insert into {TABLE_USAGE} ({', '.join(keys)}, {', '.join(measures)})
+        select {', '.join(keys.values())}, {', '.join(f'sum({e})' for e in measures.values())}
+        from {TABLE_GPT3_LOG}
+        group by {', '.join(keys.values())} ;
+    """)
+
+def ensure_usage(db_file):
+    """create aggregate table and triggers (once per process), rebuild if new;
+    needs the typed log columns from log_schema.migrate
+    """
+    with _READY_LOCK:
+        if db_file in _READY:
+            return
+        conn = sqlite3.connect(db_file, timeout=30)
+        try:
+            if not conn.execute("select 1 from sqlite_schema where type='table' and name = ?;",
+                    (TABLE_GPT3_LOG,)).fetchone():
+                return
+            is_new = not conn.execute("select 1 from sqlite_schema where type='table' and name = ?;",
+                (TABLE_USAGE,)).fetchone()
+            conn.executescript(_ddl())
+            if is_new:
+                rebuild_usage(conn)
+            conn.commit()
+        finally:
+            conn.close()
+        _READY.add(db_file)
+
+def select_usage(db_file, use_case=None, model=None, since_day=None):
+    """read aggregates only, newest day first
+    """
+    where_clause, params = [], []
+    if use_case:
+        where_clause.append("use_case = ?")
+        params.append(use_case)
+    if model:
+        where_clause.append("model = ?")
+        params.append(model)
+    if since_day:
+        where_clause.append("day >= ?")
+        params.append(str(since_day))
+    conn = sqlite3.connect(db_file)
+    try:
+        return pd.read_sql(f"""
+            select day,use_case,model,n_prompts,n_validated,prompt_tokens,completion_tokens
+            from {TABLE_USAGE}
+            {"where " + " and ".join(where_clause) if where_clause else ""}
+            order by day desc, use_case, model ;
+        """, conn, params=params)
+    finally:
+        conn.close()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Columnar export of `GPT-3 log` and query results
+
+- new log rows since the last export are appended as Parquet files
+  partitioned by dt=YYYY-MM-DD/use_case=...
+- `settings` string is parsed into typed columns
+- any DataFrame (e.g. SQL query result) can be saved as Parquet or Arrow IPC
+
+Usage:
+    python parquet_export.py [db_file] [export_dir]
+"""
+from datetime import datetime
+from os import makedirs
+from os.path import exists, join
+import re
+import sqlite3
+import sys
+
+import pandas as pd
+import yaml
+
+from db_common import parse_settings, TABLE_GPT3_LOG
+
+EXPORT_DIR = "db/export"
+EXPORT_STATE_FILE = "_export_state.yaml"
+
+# settings key -> (column name, dtype)
+SETTINGS_COLUMNS = {
+    "Mode": ("mode", "string"),
+    "Model": ("model", "string"),
+    "Temperature": ("temperature", "float64"),
+    "Maximum_length": ("max_tokens", "Int64"),
+    "Top_p": ("top_p", "float64"),
+    "Frequency_penalty": ("frequency_penalty", "float64"),
+    "Presence_penalty": ("presence_penalty", "float64"),
+}
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("pyarrow is required for Parquet/Arrow export: pip install pyarrow")
+    return pa, pq
+
+def add_settings_columns(df):
+    """expand `settings` column into typed columns
+    """
+    parsed = df["settings"].map(parse_settings)
+    for key, (col, dtype) in SETTINGS_COLUMNS.items():
+        values = parsed.map(lambda d: d.get(key))
+        if dtype == "string":
+            df[col] = values.astype("string")
+        else:
+            df[col] = pd.to_numeric(values, errors="coerce").astype(dtype)
+    return df
+
+def write_parquet(df, file_path):
+    pa, pq = _import_pyarrow()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), file_path)
+    return file_path
+
+def write_arrow(df, file_path):
+    pa, _ = _import_pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.OSFile(file_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return file_path
+
+def save_result(df, fmt="parquet", export_dir=EXPORT_DIR, name="query"):
+    """save a query result under export_dir/results/, return file path
+    """
+    out_dir = join(export_dir, "results")
+    makedirs(out_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    if fmt == "arrow":
+        return write_arrow(df, join(out_dir, f"{name}-{stamp}.arrow"))
+    return write_parquet(df, join(out_dir, f"{name}-{stamp}.parquet"))
+
+def _partition_value(s):
+    if s is None or pd.isna(s) or s == "":
+        return "__null__"
+    return re.sub(r"[^0-9A-Za-z_\-]", "_", str(s))
+
+def _read_state(export_dir):
+    state_file = join(export_dir, EXPORT_STATE_FILE)
+    if not exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return yaml.load(f.read(), Loader=yaml.SafeLoader) or {}
+
+def _write_state(export_dir, state):
+    with open(join(export_dir, EXPORT_STATE_FILE), "w") as f:
+        yaml.dump(state, f, default_flow_style=False)
+
+def export_log(db_file, export_dir=EXPORT_DIR, table_name=TABLE_GPT3_LOG):
+    """append log rows added or updated since the last export,
+    return list of files written.
+
+    New rows are tracked by rowid: rows merged in by db/merge_db.py keep the
+    source database's older ts, but get new rowids (delete then append).
+    Updated rows get a new ts, so they are exported again;
+    readers should keep the latest ts per uuid.
+    """
+    _import_pyarrow()
+    makedirs(export_dir, exist_ok=True)
+    state = _read_state(export_dir)
+    last_ts = state.get("last_ts", "")
+
+    conn = sqlite3.connect(db_file)
+    try:
+        last_rowid = state.get("last_rowid")
+        if last_rowid is None:
+            # state written before rowids were tracked
+            last_rowid = conn.execute(f"select coalesce(max(rowid), 0) from {table_name} where ts <= ?;",
+                (last_ts,)).fetchone()[0] if last_ts else 0
+        df = pd.read_sql(f"""
+            select rowid as _rowid,uuid,ts,use_case,settings,prompt,output,comment,valid_output
+            from {table_name}
+            where rowid > ? or ts > ?
+            order by ts ;
+        """, conn, params=(last_rowid, last_ts))
+    finally:
+        conn.close()
+
+    if df.empty:
+        return []
+
+    max_ts = df["ts"].max()
+    max_rowid = int(df.pop("_rowid").max())
+    df = add_settings_columns(df)
+    df["dt"] = df["ts"].str.slice(0, 10)
+    df["ts"] = pd.to_datetime(df["ts"], errors="coerce")
+
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    files = []
+    for (dt, use_case), df_part in df.groupby(["dt", "use_case"], dropna=False):
+        part_dir = join(export_dir, table_name,
+            f"dt={_partition_value(dt)}", f"use_case={_partition_value(use_case)}")
+        makedirs(part_dir, exist_ok=True)
+        files.append(write_parquet(df_part.drop(columns=["dt", "use_case"]),
+            join(part_dir, f"part-{stamp}.parquet")))
+
+    state.update({"last_ts": max(max_ts, last_ts), "last_rowid": max(max_rowid, last_rowid),
+        "last_export": str(datetime.now())})
+    _write_state(export_dir, state)
+    return files
+
+
+if __name__ == "__main__":
+    db_file = sys.argv[1] if len(sys.argv) > 1 else "db/gpt3sql.sqlite"
+    export_dir = sys.argv[2] if len(sys.argv) > 2 else EXPORT_DIR
+    files = export_log(db_file, export_dir)
+    if files:
+        print(f"Exported to '{export_dir}':\n\t" + "\n\t".join(files))
+    else:
+        print("Nothing to export")
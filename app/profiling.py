@@ -0,0 +1,119 @@
+"""
+Opt-in per-rerun profiling
+
+- wrap() times a function call; calls of kind "sql" also count towards SQL time
+  (nested sql calls are counted once) and record row counts of returned
+  DataFrames/lists
+- each rerun becomes one record in a ring buffer (last RING_SIZE reruns);
+  only calls on the thread that started the rerun are recorded, so background
+  jobs calling wrapped helpers do not leak into it
+- optionally a cProfile of the rerun is dumped as a .pstats file
+"""
+from collections import deque
+from datetime import datetime
+from functools import wraps
+from io import StringIO
+from os import makedirs
+from os.path import join
+import cProfile
+import pstats
+import re
+import threading
+import time
+
+RING_SIZE = 50
+PROFILE_DIR = "profiles"
+
+KIND_SQL = "sql"
+KIND_UI = "ui"
+
+def _row_count(result):
+    if hasattr(result, "shape"):
+        return int(result.shape[0])
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return None
+
+class Profiler(object):
+    def __init__(self, ring_size=RING_SIZE):
+        self.reruns = deque(maxlen=ring_size)
+        self._current = None
+        self._sql_depth = 0
+        self._thread_id = None
+
+    def start_rerun(self, label=""):
+        self._current = {
+            "ts": str(datetime.now()),
+            "label": label,
+            "ts_start": time.perf_counter(),
+            "calls": [],
+            "sql_sec": 0.0,
+            "rows": 0,
+            "pstats_file": None,
+        }
+        self._sql_depth = 0
+        self._thread_id = threading.get_ident()
+
+    def end_rerun(self):
+        rerun = self._current
+        if rerun is None:
+            return None
+        rerun["wall_sec"] = time.perf_counter() - rerun.pop("ts_start")
+        self.reruns.append(rerun)
+        self._current = None
+        return rerun
+
+    def wrap(self, fn, kind=KIND_UI):
+        @wraps(fn)
+        def _wrapper(*args, **kwargs):
+            rerun = self._current
+            if rerun is None or threading.get_ident() != self._thread_id:
+                return fn(*args, **kwargs)
+            is_outer_sql = kind == KIND_SQL and self._sql_depth == 0
+            if kind == KIND_SQL:
+                self._sql_depth += 1
+            ts_start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - ts_start
+                if kind == KIND_SQL:
+                    self._sql_depth -= 1
+            rows = _row_count(result)
+            rerun["calls"].append({"fn": fn.__name__, "kind": kind, "sec": elapsed, "rows": rows})
+            if is_outer_sql:
+                rerun["sql_sec"] += elapsed
+                rerun["rows"] += rows or 0
+            return result
+        return _wrapper
+
+    def run_cprofile(self, fn, profile_dir=PROFILE_DIR):
+        """run fn() under cProfile, dump stats of this rerun to profile_dir
+        """
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(fn)
+        finally:
+            makedirs(profile_dir, exist_ok=True)
+            label = re.sub(r"\W", "_", (self._current or {}).get("label", "")) or "rerun"
+            file_path = join(profile_dir, f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}-{label}.pstats")
+            prof.dump_stats(file_path)
+            if self._current is not None:
+                self._current["pstats_file"] = file_path
+
+    def summary(self):
+        """one row per rerun, newest first
+        """
+        return [{
+            "ts": r["ts"],
+            "label": r["label"],
+            "wall_sec": round(r["wall_sec"], 4),
+            "sql_sec": round(r["sql_sec"], 4),
+            "rows": r["rows"],
+            "calls": len(r["calls"]),
+        } for r in reversed(self.reruns)]
+
+def pstats_top(file_path, n=20, sort_by="cumulative"):
+    out = StringIO()
+    pstats.Stats(file_path, stream=out).sort_stats(sort_by).print_stats(n)
+    return out.getvalue()
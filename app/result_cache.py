@@ -0,0 +1,106 @@
+"""
+In-memory cache of SQL query results
+
+- results are keyed on normalized SQL, file identity and PRAGMA data_version
+- entries are evicted in LRU order once the total size exceeds a byte budget
+- lives in its own module so the cache survives Streamlit reruns
+"""
+from collections import OrderedDict
+from os import stat
+from threading import Lock
+import re
+import sqlite3
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# quoted literal/identifier | run of whitespace, -- line comments and /* block comments */
+_RE_SQL_TOKEN = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|(?:\s+|--[^\n]*|/\*.*?(?:\*/|$))+", re.DOTALL)
+
+def normalize_sql(code):
+    """strip comments and collapse whitespace outside of quoted literals, drop trailing semicolons;
+    comments are removed before whitespace is folded, so a `--` comment never swallows the next line
+    """
+    def _repl(m):
+        return m.group(1) if m.group(1) else " "
+    return _RE_SQL_TOKEN.sub(_repl, code).strip().rstrip(";").strip()
+
+def _file_identity(db_file):
+    st_ = stat(db_file)
+    return (st_.st_dev, st_.st_ino, st_.st_size, st_.st_mtime_ns)
+
+def _df_size(df):
+    try:
+        return int(df.memory_usage(index=True, deep=True).sum())
+    except Exception:
+        return 0
+
+class ResultCache(object):
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (df, nbytes)
+        self._probes = dict()           # db_file -> long-lived connection for data_version
+        self._lock = Lock()
+
+    def _data_version(self, db_file):
+        """PRAGMA data_version is only comparable on the same connection,
+        so keep one probe connection open per database file
+        """
+        conn = self._probes.get(db_file)
+        if conn is None:
+            conn = sqlite3.connect(db_file, check_same_thread=False)
+            self._probes[db_file] = conn
+        return conn.execute("PRAGMA data_version;").fetchone()[0]
+
+    def make_key(self, db_file, code, variant=""):
+        """variant separates results of the same query, e.g. per engine
+        """
+        with self._lock:
+            version = self._data_version(db_file)
+        return (db_file, _file_identity(db_file), version, variant, normalize_sql(code))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, df):
+        nbytes = _df_size(df)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._entries[key] = (df, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, (_, n) = self._entries.popitem(last=False)
+                self.total_bytes -= n
+
+    def invalidate(self, db_file=None):
+        """drop cached results for one database file (or all when db_file is None)
+        """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if db_file is None or key[0] == db_file:
+                    self.total_bytes -= self._entries.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+SQL_RESULT_CACHE = ResultCache()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Foreign-key-preserving sample of a SQLite database
+
+- each table keeps a fraction of its rows (at least MIN_ROWS when available),
+  picked in a deterministic pseudo-random rowid order so rebuilds are consistent
+- parent rows referenced by sampled rows are pulled in until closure
+- sample is a regular SQLite file next to the source, rebuilt only when the
+  schema, max(rowid) or count(*) of a sampled table changes
+  (in-place UPDATEs are not detected, use build_sample(force=True))
+- queries on the sample report a rough full-size runtime and row count,
+  scaled by the source/sample row ratio of the tables the query reads
+
+Usage:
+    python sample_db.py <db_file> [fraction]
+"""
+from datetime import datetime
+from math import ceil
+from os import close, remove, replace
+from os.path import abspath, basename, dirname, exists, splitext
+from tempfile import mkstemp
+from threading import Lock
+import re
+import sqlite3
+import sys
+import time
+
+from db_common import quote_ident
+from sqlite_explore import connect_readonly, run_query, EXPLORE_TIMEOUT_SEC
+
+SAMPLE_FRACTION = 0.01
+MIN_ROWS = 10
+MAX_CLOSURE_ROUNDS = 20
+TABLE_SAMPLE_META = "_sample_meta"
+
+_BUILD_LOCKS = dict()    # sample_file -> Lock, all sessions share one process
+_BUILD_LOCKS_LOCK = Lock()
+
+# multiplicative hash of rowid gives a stable shuffled order
+_ROWID_ORDER = "(rowid * 2654435761) % 4294967296"
+
+def sample_file_path(db_file, fraction=SAMPLE_FRACTION):
+    root, ext = splitext(db_file)
+    return f"{root}.sample_{fraction*100:g}pct{ext or '.sqlite'}"
+
+def _source_tables(conn, schema="main", exclude_tables=()):
+    exclude = [t.lower() for t in exclude_tables]
+    return [name for (name,) in conn.execute(f"""
+            select name from {schema}.sqlite_schema
+            where type = 'table' and name not like 'sqlite_%' ;
+        """).fetchall() if name.lower() not in exclude]
+
+def _source_identity(db_file, exclude_tables=()):
+    """change signature: schema version plus max(rowid) and count(*) of each sampled table,
+    so inserts and deletes are detected, while writes to excluded (e.g. log) tables
+    do not force a rebuild
+    """
+    conn = sqlite3.connect(db_file)
+    try:
+        parts = [str(conn.execute("PRAGMA schema_version;").fetchone()[0])]
+        for table in _source_tables(conn, exclude_tables=exclude_tables):
+            n = conn.execute(f"select count(*) from {quote_ident(table)};").fetchone()[0]
+            try:
+                max_rowid = conn.execute(f"select max(rowid) from {quote_ident(table)};").fetchone()[0]
+            except sqlite3.OperationalError:
+                max_rowid = ""     # WITHOUT ROWID table
+            parts.append(f"{table}={max_rowid}/{n}")
+    finally:
+        conn.close()
+    return ";".join(parts)
+
+def _is_current(sample_file, source_identity, fraction):
+    if not exists(sample_file):
+        return False
+    conn = sqlite3.connect(sample_file)
+    try:
+        row = conn.execute(f"select source_identity, fraction from {TABLE_SAMPLE_META} limit 1;").fetchone()
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+    return row is not None and row[0] == source_identity and row[1] == fraction
+
+def build_sample(db_file, fraction=SAMPLE_FRACTION, sample_file=None, force=False, exclude_tables=()):
+    """build (or reuse) the sample database, return its file path,
+    exclude_tables are left out (e.g. app log tables)
+    """
+    sample_file = sample_file or sample_file_path(db_file, fraction)
+    source_identity = _source_identity(db_file, exclude_tables)
+    if not force and _is_current(sample_file, source_identity, fraction):
+        return sample_file
+
+    with _BUILD_LOCKS_LOCK:
+        lock = _BUILD_LOCKS.setdefault(abspath(sample_file), Lock())
+    with lock:
+        # another session may have built it while we waited
+        source_identity = _source_identity(db_file, exclude_tables)
+        if not force and _is_current(sample_file, source_identity, fraction):
+            return sample_file
+
+        # build into a unique temp file next to the sample, then swap in atomically
+        fd, tmp_file = mkstemp(prefix=f"{basename(sample_file)}.", suffix=".tmp",
+            dir=dirname(abspath(sample_file)))
+        close(fd)
+        try:
+            _build_sample_file(db_file, tmp_file, source_identity, fraction, exclude_tables)
+            replace(tmp_file, sample_file)
+        finally:
+            if exists(tmp_file):     # build failed before the swap
+                remove(tmp_file)
+    return sample_file
+
+def _build_sample_file(db_file, tmp_file, source_identity, fraction, exclude_tables):
+    """sample db_file into the new (empty) tmp_file
+    """
+    conn = sqlite3.connect(tmp_file)
+    try:
+        conn.execute("ATTACH DATABASE ? AS src;", (db_file,))
+        tables = _source_tables(conn, schema="src", exclude_tables=exclude_tables)
+        schema = [(type_, name, sql) for type_, name, tbl_name, sql in conn.execute("""
+            select type, name, tbl_name, sql from src.sqlite_schema
+            where sql is not null and name not like 'sqlite_%'
+            order by case type when 'table' then 0 else 1 end ;
+        """).fetchall() if tbl_name in tables]
+
+        # tables first, indexes/triggers/views after loading
+        for type_, _, sql in schema:
+            if type_ == "table":
+                conn.execute(sql)
+
+        # sample rows of each table
+        for table in tables:
+            n = conn.execute(f"select count(*) from src.{quote_ident(table)};").fetchone()[0]
+            k = max(ceil(n * fraction), min(n, MIN_ROWS))
+            try:
+                conn.execute(f"""
+                    insert into main.{quote_ident(table)}
+                    select * from src.{quote_ident(table)} order by {_ROWID_ORDER} limit {k};
+                """)
+            except sqlite3.OperationalError:
+                # WITHOUT ROWID table
+                conn.execute(f"insert into main.{quote_ident(table)} select * from src.{quote_ident(table)} limit {k};")
+
+        # pull in referenced parent rows until closure
+        fks = []
+        for table in tables:
+            for row in conn.execute(f"PRAGMA src.foreign_key_list({quote_ident(table)});").fetchall():
+                _, _, parent, from_col, to_col = row[:5]
+                if parent not in tables:
+                    continue
+                if to_col is None:
+                    # implicit reference to parent's primary key
+                    pk = [r[1] for r in conn.execute(f"PRAGMA src.table_info({quote_ident(parent)});") if r[5] == 1]
+                    if len(pk) != 1:
+                        continue
+                    to_col = pk[0]
+                fks.append((table, parent, from_col, to_col))
+        for _ in range(MAX_CLOSURE_ROUNDS):
+            added = 0
+            for child, parent, from_col, to_col in fks:
+                cur = conn.execute(f"""
+                    insert into main.{quote_ident(parent)}
+                    select * from src.{quote_ident(parent)} p
+                    where p.{quote_ident(to_col)} in (select {quote_ident(from_col)} from main.{quote_ident(child)})
+                      and not exists (select 1 from main.{quote_ident(parent)} m
+                                      where m.{quote_ident(to_col)} = p.{quote_ident(to_col)});
+                """)
+                added += cur.rowcount
+            if not added:
+                break
+
+        for type_, _, sql in schema:
+            if type_ != "table":
+                conn.execute(sql)
+
+        # one row per sampled table, FK closure makes the ratio differ per table
+        conn.execute(f"""create table {TABLE_SAMPLE_META} (source_identity text, fraction real, built_at text,
+            table_name text, source_rows integer, sample_rows integer);""")
+        built_at = str(datetime.now())
+        conn.executemany(f"insert into {TABLE_SAMPLE_META} values (?, ?, ?, ?, ?, ?);", [
+            (source_identity, fraction, built_at, t,
+                conn.execute(f"select count(*) from src.{quote_ident(t)};").fetchone()[0],
+                conn.execute(f"select count(*) from main.{quote_ident(t)};").fetchone()[0])
+            for t in tables])
+        conn.commit()
+        conn.execute("DETACH DATABASE src;")
+    finally:
+        conn.close()
+
+def _table_scales(sample_file):
+    """return ({table: source rows / sample rows}, built_at)
+    """
+    conn = sqlite3.connect(sample_file)
+    try:
+        rows = conn.execute(f"select table_name, source_rows, sample_rows, built_at from {TABLE_SAMPLE_META};").fetchall()
+    finally:
+        conn.close()
+    scales = {t: (src / smp if smp else 1.0) for t, src, smp, _ in rows}
+    return scales, (rows[0][3] if rows else None)
+
+def _tables_read(sample_file, sql):
+    """tables whose b-trees (table or index) the query opens, from EXPLAIN OpenRead root pages,
+    so aliases, subqueries and covering indexes are resolved by SQLite itself
+    """
+    conn = connect_readonly(sample_file, immutable=True)
+    try:
+        root_pages = {rootpage: tbl_name for rootpage, tbl_name in conn.execute(
+            "select rootpage, tbl_name from sqlite_schema where rootpage > 0;")}
+        # EXPLAIN columns: addr, opcode, p1, p2 (root page), p3 (database), ...
+        return {root_pages[r[3]] for r in conn.execute(f"EXPLAIN {sql}")
+            if r[1] == "OpenRead" and r[4] == 0 and r[3] in root_pages}
+    finally:
+        conn.close()
+
+def _query_scales(sample_file, sql):
+    """return ({table: row ratio} for the tables the query reads, built_at),
+    all sampled tables if the plan cannot be read
+    """
+    scales, built_at = _table_scales(sample_file)
+    try:
+        tables = _tables_read(sample_file, sql.strip().rstrip(";"))
+    except sqlite3.Error:
+        tables = set()
+    return {t: scales.get(t, 1.0) for t in (tables or scales)}, built_at
+
+_RE_LIMIT = re.compile(r"\blimit\s+(\d+)\s*;?\s*$", re.IGNORECASE)
+_RE_AGGREGATE = re.compile(r"\b(count|sum|avg|min|max|total|group_concat)\s*\(", re.IGNORECASE)
+_RE_GROUP_BY = re.compile(r"\bgroup\s+by\b", re.IGNORECASE)
+
+def run_on_sample(db_file, sql, fraction=SAMPLE_FRACTION, timeout_sec=EXPLORE_TIMEOUT_SEC, exclude_tables=()):
+    """run SELECT on the sample db, return (df, estimate) where estimate has
+    sample/estimated-full runtime (sec) and row count, a rough linear extrapolation
+    by the row ratio of the tables read
+    """
+    sample_file = build_sample(db_file, fraction, exclude_tables=exclude_tables)
+    scales, built_at = _query_scales(sample_file, sql)
+    # with FK joins the result grows with the most sampled (child-most) table
+    scale = max(scales.values(), default=1.0)
+    ts_start = time.monotonic()
+    # sample file is only ever replaced whole, never written in place
+    df = run_query(sample_file, sql, timeout_sec=timeout_sec, immutable=True)
+    elapsed = time.monotonic() - ts_start
+    if _RE_AGGREGATE.search(sql) and not _RE_GROUP_BY.search(sql):
+        # plain aggregate returns the same number of rows at full size
+        est_rows_min = est_rows = len(df)
+    elif _RE_GROUP_BY.search(sql):
+        # number of groups grows anywhere from not at all to linearly
+        est_rows_min, est_rows = len(df), int(round(len(df) * scale))
+    else:
+        est_rows_min = est_rows = int(round(len(df) * scale))
+    m = _RE_LIMIT.search(sql.strip())
+    if m:
+        est_rows_min = min(est_rows_min, int(m.group(1)))
+        est_rows = min(est_rows, int(m.group(1)))
+    estimate = {
+        "sample_file": sample_file,
+        "scale": scale,
+        "tables": sorted(scales),
+        "sample_built_at": built_at,
+        "sample_sec": elapsed,
+        "est_full_sec": elapsed * scale,
+        "sample_rows": len(df),
+        "est_full_rows_min": est_rows_min,
+        "est_full_rows": est_rows,
+    }
+    return df, estimate
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        db_file = sys.argv[1]
+        fraction = float(sys.argv[2]) if len(sys.argv) > 2 else SAMPLE_FRACTION
+        print(f"Sample DB: {build_sample(db_file, fraction, force=True)}")
+    else:
+        print("[Error] source DB file missing!")
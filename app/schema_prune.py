@@ -0,0 +1,141 @@
+"""
+Relevance-based schema pruning for SQL prompts
+
+- tables, columns and foreign keys are read from sqlite_schema / PRAGMA table_info /
+  PRAGMA foreign_key_list, and cached per database until its schema_version changes
+- tables are scored against the question with a local lexical index
+  (IDF-weighted matches on table and column name tokens),
+  plus a share of the score of their foreign-key neighbours
+- only the top-k tables scoring at least MIN_SCORE_RATIO of the best go into
+  the "Table x, columns = [...]" prompt header (the most FK-connected tables
+  when nothing matches)
+- words already covered by tables declared in the prompt do not count,
+  so a prompt that declares what it needs gets no extra tables
+"""
+from math import log
+from threading import Lock
+import re
+import sqlite3
+
+from db_common import quote_ident
+
+TOP_K = 4
+TABLE_NAME_WEIGHT = 3.0
+COLUMN_NAME_WEIGHT = 1.0
+FK_NEIGHBOUR_WEIGHT = 0.3
+MIN_SCORE_RATIO = 0.25     # tables scoring below this fraction of the top score are dropped
+
+_SCHEMA_CACHE = dict()    # db_file -> (schema_version, schema)
+_SCHEMA_LOCK = Lock()
+
+_RE_CAMEL = re.compile(r"([a-z0-9])([A-Z])")
+_RE_WORD = re.compile(r"[A-Za-z0-9]+")
+
+def _stem(token):
+    """crude plural folding: categories -> category, genres -> genre
+    """
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+def tokenize(text):
+    """split identifiers/text into lowercase stemmed tokens,
+    e.g. "InvoiceLineId" -> {"invoice", "line", "id"}
+    """
+    text = _RE_CAMEL.sub(r"\1 \2", text.replace("_", " "))
+    return {_stem(w.lower()) for w in _RE_WORD.findall(text)}
+
+def load_schema(db_file):
+    """return {table: {"columns": [...], "fks": [parent tables]}}
+    """
+    conn = sqlite3.connect(db_file)
+    try:
+        version = conn.execute("PRAGMA schema_version;").fetchone()[0]
+        with _SCHEMA_LOCK:
+            cached = _SCHEMA_CACHE.get(db_file)
+            if cached and cached[0] == version:
+                return cached[1]
+        schema = {}
+        tables = [name for (name,) in conn.execute("""
+            select name from sqlite_schema
+            where type = 'table' and name not like 'sqlite_%' ;
+        """).fetchall()]
+        for table in tables:
+            columns = [r[1] for r in conn.execute(f"PRAGMA table_info({quote_ident(table)});")]
+            fks = sorted({r[2] for r in conn.execute(f"PRAGMA foreign_key_list({quote_ident(table)});")})
+            schema[table] = {"columns": columns, "fks": fks}
+    finally:
+        conn.close()
+    with _SCHEMA_LOCK:
+        _SCHEMA_CACHE[db_file] = (version, schema)
+    return schema
+
+def _table_tokens(table, columns):
+    return tokenize(table).union(*[tokenize(c) for c in columns])
+
+def score_tables(schema, question, ignore_tokens=()):
+    """return {table: score} of lexical relevance to question,
+    ignore_tokens do not count as matches
+    """
+    q_tokens = tokenize(question) - set(ignore_tokens)
+    n_tables = len(schema) or 1
+    table_tokens = {t: tokenize(t) for t in schema}
+    column_tokens = {t: set().union(*[tokenize(c) for c in v["columns"]]) if v["columns"] else set()
+        for t, v in schema.items()}
+
+    # document frequency of each token over tables (name + columns)
+    df = {}
+    for t in schema:
+        for tok in table_tokens[t] | column_tokens[t]:
+            df[tok] = df.get(tok, 0) + 1
+    idf = {tok: log(1 + n_tables / n) for tok, n in df.items()}
+
+    base = {}
+    for t in schema:
+        s = sum(TABLE_NAME_WEIGHT * idf[tok] for tok in q_tokens & table_tokens[t])
+        s += sum(COLUMN_NAME_WEIGHT * idf[tok] for tok in q_tokens & column_tokens[t])
+        base[t] = s
+
+    # foreign keys in both directions
+    neighbours = {t: set(v["fks"]) for t, v in schema.items()}
+    for t, v in schema.items():
+        for parent in v["fks"]:
+            if parent in neighbours:
+                neighbours[parent].add(t)
+    return {t: base[t] + FK_NEIGHBOUR_WEIGHT * sum(base.get(n, 0) for n in neighbours[t] if n != t)
+        for t in schema}
+
+def _fk_degree(schema):
+    """number of foreign-key links per table, in either direction
+    """
+    degree = {t: len(v["fks"]) for t, v in schema.items()}
+    for v in schema.values():
+        for parent in v["fks"]:
+            if parent in degree:
+                degree[parent] += 1
+    return degree
+
+def prune_schema(db_file, question, top_k=TOP_K, exclude_tables=(), known_tables=()):
+    """return [(table, columns)] of up to top_k relevant tables, without known_tables
+    (declared in the prompt already, their table/column words are not matched again);
+    when nothing matches, the top_k most connected (FK hub) tables, or none if tables are known
+    """
+    full_schema = load_schema(db_file)
+    known = {t.lower() for t in known_tables}
+    exclude = {t.lower() for t in exclude_tables} | known
+    schema = {t: v for t, v in full_schema.items() if t.lower() not in exclude}
+    known_tokens = set().union(*[_table_tokens(t, v["columns"]) for t, v in full_schema.items()
+        if t.lower() in known])
+    scores = score_tables(schema, question, ignore_tokens=known_tokens)
+    top_score = max(scores.values(), default=0)
+    ranked = [t for t in sorted(schema, key=lambda t: -scores[t])
+        if scores[t] > 0 and scores[t] >= MIN_SCORE_RATIO * top_score][:top_k]
+    if not ranked and not known:
+        degree = _fk_degree(schema)
+        ranked = sorted(schema, key=lambda t: (-degree[t], t))[:top_k]
+    return [(t, schema[t]["columns"]) for t in ranked]
+
+def schema_header(tables):
+    return "\n".join(f"Table {t}, columns = [{', '.join(cols)}]" for t, cols in tables)
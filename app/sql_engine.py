@@ -0,0 +1,194 @@
+"""
+Pluggable engines for running SELECT queries in Run SQL
+
+- sqlite: read-only connection from sqlite_explore (default)
+- duckdb: attaches the same SQLite file through DuckDB's sqlite extension,
+  and exposes Parquet exports as <table>_parquet views
+- every engine runs the query on a worker thread under a deadline and
+  can be cancelled; connection setup and execution are timed separately,
+  so engines can be compared side by side on execution alone
+- duckdb is offered whenever it is installed; its sqlite extension is probed
+  (and installed if needed) once per process, without it only the
+  <table>_parquet views can be queried
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir
+from os.path import abspath, isdir, join
+from threading import Event, Lock, Thread
+import time
+
+import pandas as pd
+
+from db_common import quote_ident
+from parquet_export import EXPORT_DIR
+from sqlite_explore import run_query, QueryCancelled, QueryTimeout, EXPLORE_TIMEOUT_SEC
+
+ENGINE_SQLITE = "sqlite"
+ENGINE_DUCKDB = "duckdb"
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sql_engine")
+
+_DUCKDB_STATUS = {}     # "ok": duckdb importable, "sqlite": extension loadable, "error": str
+_DUCKDB_LOCK = Lock()
+
+
+def _sql_str(s):
+    return "'" + str(s).replace("'", "''") + "'"
+
+
+class SQLiteEngine(object):
+    name = ENGINE_SQLITE
+
+    def available(self):
+        return True, None
+
+    def query(self, db_file, sql, timeout_sec=EXPLORE_TIMEOUT_SEC, cancel_event=None, timings=None):
+        # connecting to SQLite is negligible, time it all as execution
+        ts_start = time.monotonic()
+        try:
+            return run_query(db_file, sql, timeout_sec=timeout_sec, cancel_event=cancel_event)
+        finally:
+            if timings is not None:
+                timings.update({"setup_sec": 0.0, "exec_sec": time.monotonic() - ts_start})
+
+
+class DuckDBEngine(object):
+    name = ENGINE_DUCKDB
+
+    def __init__(self, export_dir=EXPORT_DIR):
+        self.export_dir = export_dir
+
+    def _probe(self):
+        """probe duckdb and its sqlite extension once per process;
+        INSTALL (a download) is only tried when the extension is not installed yet
+        """
+        with _DUCKDB_LOCK:
+            if _DUCKDB_STATUS:
+                return _DUCKDB_STATUS
+            try:
+                import duckdb
+            except ImportError:
+                _DUCKDB_STATUS.update({"ok": False, "sqlite": False, "error": "duckdb is not installed"})
+                return _DUCKDB_STATUS
+            conn = duckdb.connect()
+            try:
+                conn.execute("SET autoinstall_known_extensions = false;")
+                try:
+                    conn.execute("LOAD sqlite;")
+                except duckdb.Error:
+                    conn.execute("INSTALL sqlite; LOAD sqlite;")
+                _DUCKDB_STATUS.update({"ok": True, "sqlite": True, "error": None})
+            except Exception as e:
+                _DUCKDB_STATUS.update({"ok": True, "sqlite": False, "error": f"{type(e).__name__}: {e}"})
+            finally:
+                conn.close()
+            return _DUCKDB_STATUS
+
+    def available(self):
+        """(ok, note): usable without the sqlite extension, note says what is missing
+        """
+        status = self._probe()
+        if not status["ok"]:
+            return False, status["error"]
+        if not status["sqlite"]:
+            return True, f"sqlite extension unavailable ({status['error']}), only <table>_parquet views can be queried"
+        return True, None
+
+    def _connect(self, db_file):
+        status = self._probe()
+        if not status["ok"]:
+            raise RuntimeError(f"DuckDB engine unavailable: {status['error']}")
+        import duckdb
+        conn = duckdb.connect()
+        if status["sqlite"]:
+            conn.execute("SET autoinstall_known_extensions = false; LOAD sqlite;")
+            conn.execute(f"ATTACH {_sql_str(abspath(db_file))} AS db (TYPE SQLITE, READ_ONLY);")
+            conn.execute("USE db;")
+        self._register_parquet_views(conn)
+        return conn
+
+    def _register_parquet_views(self, conn):
+        """expose each exported table (EXPORT_DIR/<table>/**/*.parquet) as <table>_parquet
+        """
+        if not isdir(self.export_dir):
+            return
+        for table in listdir(self.export_dir):
+            table_dir = join(abspath(self.export_dir), table)
+            if table == "results" or not isdir(table_dir):
+                continue
+            conn.execute(f"""
+                CREATE OR REPLACE TEMP VIEW {quote_ident(f"{table}_parquet")} AS
+                SELECT * FROM read_parquet({_sql_str(f"{table_dir}/**/*.parquet")}, hive_partitioning=true);
+            """)
+
+    def query(self, db_file, sql, timeout_sec=EXPLORE_TIMEOUT_SEC, cancel_event=None, timings=None):
+        ts_start = time.monotonic()
+        conn = self._connect(db_file)
+        ts_exec = time.monotonic()
+        cancel_event = cancel_event or Event()
+        done = Event()
+        reason = {}
+
+        def _watchdog():
+            # interrupt on cancel or deadline, whichever comes first
+            if cancel_event.wait(timeout=timeout_sec):
+                reason["why"] = "cancelled"
+            else:
+                reason["why"] = "timeout"
+            if not done.is_set():
+                conn.interrupt()
+
+        Thread(target=_watchdog, daemon=True).start()
+        try:
+            return conn.execute(sql).df()
+        except Exception as e:
+            if reason.get("why") == "cancelled":
+                raise QueryCancelled("Query cancelled") from e
+            if reason.get("why") == "timeout":
+                raise QueryTimeout(f"Query exceeded {timeout_sec} sec deadline") from e
+            raise
+        finally:
+            if timings is not None:
+                timings.update({"setup_sec": ts_exec - ts_start, "exec_sec": time.monotonic() - ts_exec})
+            done.set()
+            cancel_event.set()   # release watchdog
+            conn.close()
+
+
+ENGINES = {
+    ENGINE_SQLITE: SQLiteEngine(),
+    ENGINE_DUCKDB: DuckDBEngine(),
+}
+
+def available_engines():
+    return [name for name, engine in ENGINES.items() if engine.available()[0]]
+
+def timed_query(engine_name, db_file, sql, timeout_sec=EXPLORE_TIMEOUT_SEC, cancel_event=None):
+    """return (df, timings) where timings has setup_sec (connect, attach, views)
+    and exec_sec (the query itself)
+    """
+    timings = {}
+    df = ENGINES[engine_name].query(db_file, sql, timeout_sec=timeout_sec, cancel_event=cancel_event, timings=timings)
+    return df, timings
+
+def submit_query(engine_name, db_file, sql, timeout_sec=EXPLORE_TIMEOUT_SEC):
+    """run timed_query on a worker thread, return (future, cancel_event)
+    """
+    cancel_event = Event()
+    future = _EXECUTOR.submit(timed_query, engine_name, db_file, sql, timeout_sec, cancel_event)
+    return future, cancel_event
+
+def compare_timings(results):
+    """results: {engine_name: (df, timings, error)} -> summary DataFrame,
+    a failed engine shows up as a row with its error
+    """
+    return pd.DataFrame([
+        {
+            "engine": name,
+            "exec_sec": round(timings["exec_sec"], 4) if "exec_sec" in timings else None,
+            "setup_sec": round(timings["setup_sec"], 4) if "setup_sec" in timings else None,
+            "rows": len(df) if df is not None else None,
+            "error": error,
+        }
+        for name, (df, timings, error) in results.items()
+    ])
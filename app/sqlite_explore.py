@@ -0,0 +1,75 @@
+"""
+Read-only connections for exploring the sample database
+
+- opened by file: URI with mode=ro, so write statements are rejected;
+  immutable=1 only for files nothing writes to (the sample database),
+  never for DB_FILE which the app writes to while reads run
+- large mmap_size lets SQLite read pages straight from the OS page cache
+- every query runs under a deadline enforced by set_progress_handler,
+  and can be cancelled from another thread
+"""
+from os.path import abspath
+from pathlib import Path
+import sqlite3
+import time
+
+import pandas as pd
+
+EXPLORE_MMAP_SIZE = 256 * 1024 * 1024
+EXPLORE_TIMEOUT_SEC = 30
+PROGRESS_N_OPS = 10000     # VM instructions between progress handler calls
+
+class QueryCancelled(Exception):
+    pass
+
+class QueryTimeout(Exception):
+    pass
+
+def readonly_uri(db_file, immutable=False):
+    uri = Path(abspath(db_file)).as_uri() + "?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    return uri
+
+def connect_readonly(db_file, immutable=False, mmap_size=EXPLORE_MMAP_SIZE):
+    """open db_file read-only;
+    immutable=True skips locking and change detection, only safe if no one writes the file
+    """
+    conn = sqlite3.connect(readonly_uri(db_file, immutable=immutable), uri=True, check_same_thread=False)
+    conn.execute(f"PRAGMA mmap_size = {int(mmap_size)};")
+    return conn
+
+class ExploreConn(object):
+    def __init__(self, db_file, immutable=False):
+        self.conn = connect_readonly(db_file, immutable=immutable)
+    def __enter__(self):
+        return self.conn
+    def __exit__(self, type, value, traceback):
+        self.conn.close()
+
+def run_query(db_file, sql, timeout_sec=EXPLORE_TIMEOUT_SEC, cancel_event=None, immutable=False):
+    """run a SELECT on a read-only connection and return a DataFrame,
+    raise QueryTimeout/QueryCancelled if the deadline passes or cancel_event is set
+    """
+    deadline = time.monotonic() + timeout_sec
+    reason = {}
+
+    def _progress():
+        if cancel_event is not None and cancel_event.is_set():
+            reason["why"] = "cancelled"
+            return 1
+        if time.monotonic() > deadline:
+            reason["why"] = "timeout"
+            return 1
+        return 0
+
+    with ExploreConn(db_file, immutable=immutable) as _conn:
+        _conn.set_progress_handler(_progress, PROGRESS_N_OPS)
+        try:
+            return pd.read_sql(sql, _conn)
+        except Exception as e:
+            if reason.get("why") == "cancelled":
+                raise QueryCancelled("Query cancelled") from e
+            if reason.get("why") == "timeout":
+                raise QueryTimeout(f"Query exceeded {timeout_sec} sec deadline") from e
+            raise